@@ -1,6 +1,6 @@
 from django import forms
 from django.contrib import admin
-from api.models import AuthEvent, UserData, ACL, User
+from api.models import AuthEvent, UserData, ACL, User, UniqueValue, CensusJob, SendAuthJob
 from authmethods.models import Message, ColorList, Code, Connection
 from authmethods import METHODS
 from django.contrib.auth.admin import UserAdmin
@@ -27,6 +27,14 @@ class AuthEventAdmin(admin.ModelAdmin):
     list_filter = ('auth_method', 'status')
     search_fields = ('id',)
 
+    def save_model(self, request, obj, form, change):
+        # only the form fields, so a colorlist_version changed meanwhile
+        # isn't saved back
+        if change:
+            obj.save(update_fields=form.changed_data)
+        else:
+            obj.save()
+
 
 class UserDataAdmin(admin.ModelAdmin):
     list_display = ('user', 'status')
@@ -40,6 +48,21 @@ class ACLAdmin(admin.ModelAdmin):
                      'perm', 'object_type', 'object_id')
 
 
+class UniqueValueAdmin(admin.ModelAdmin):
+    list_display = ('event', 'name', 'value', 'user')
+    search_fields = ('name', 'value')
+
+
+class CensusJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'event', 'status', 'processed', 'rejected', 'created')
+    list_filter = ('status',)
+    exclude = ('payload',)
+
+
+class SendAuthJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'event', 'total', 'chunks', 'chunks_done', 'sent', 'created')
+
+
 class ColorListAdmin(admin.ModelAdmin):
     pass
 
@@ -76,6 +99,9 @@ admin.site.register(User, CustomUserAdmin)
 admin.site.register(AuthEvent, AuthEventAdmin)
 admin.site.register(UserData, UserDataAdmin)
 admin.site.register(ACL, ACLAdmin)
+admin.site.register(UniqueValue, UniqueValueAdmin)
+admin.site.register(CensusJob, CensusJobAdmin)
+admin.site.register(SendAuthJob, SendAuthJobAdmin)
 admin.site.register(ColorList, ColorListAdmin)
 admin.site.register(Message, MessageAdmin)
 admin.site.register(Code, CodeAdmin)
@@ -0,0 +1,28 @@
+import time
+from django.core.management.base import BaseCommand
+
+from authmethods.utils import get_cannonical_tlf, get_cannonical_tlfs
+
+
+class Command(BaseCommand):
+    args = '[count]'
+    help = ('Times the conversion of a census column of count tlf numbers '
+            '(1000000 by default) to the canonical format, one by one and '
+            'in a batch')
+
+    def handle(self, *args, **options):
+        count = int(args[0]) if args else 1000000
+        formats = ('6%08d', '+346%08d', '00346%08d')
+        tlfs = [formats[i % 3] % (i % 200000) for i in range(count)]
+
+        start = time.time()
+        expected = [get_cannonical_tlf(tlf) for tlf in tlfs]
+        single = time.time() - start
+
+        start = time.time()
+        result = get_cannonical_tlfs(tlfs)
+        batch = time.time() - start
+
+        if result != expected:
+            self.stderr.write('the batch and single conversions differ')
+        self.stdout.write('%d tlfs: %.3fs one by one, %.3fs in a batch' % (count, single, batch))
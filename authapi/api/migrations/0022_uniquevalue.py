@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import json
+from django.db import models, migrations
+
+
+def normalize(value):
+    value = json.dumps(value, sort_keys=True, ensure_ascii=False)
+    if len(value) > 255:
+        value = 'sha256:' + hashlib.sha256(value.encode('utf-8')).hexdigest()
+    return value
+
+
+def backfill_unique_values(apps, schema_editor):
+    AuthEvent = apps.get_model('api', 'AuthEvent')
+    UserData = apps.get_model('api', 'UserData')
+    UniqueValue = apps.get_model('api', 'UniqueValue')
+
+    for ae in AuthEvent.objects.all():
+        uniques = [extra.get('name') for extra in ae.extra_fields or []
+                   if extra.get('unique')]
+        if not uniques:
+            continue
+        values = []
+        for ud in UserData.objects.filter(event=ae).iterator():
+            metadata = ud.metadata or '{}'
+            if isinstance(metadata, str):
+                metadata = json.loads(metadata)
+            for name in uniques:
+                if metadata.get(name) is not None:
+                    values.append(UniqueValue(user_id=ud.id, event_id=ae.id,
+                        name=name, value=normalize(metadata.get(name))))
+        UniqueValue.objects.bulk_create(values)
+
+
+def remove_unique_values(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_acl_created'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UniqueValue',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+                ('value', models.CharField(max_length=255)),
+                ('event', models.ForeignKey(related_name='unique_values', to='api.AuthEvent')),
+                ('user', models.ForeignKey(related_name='unique_values', to='api.UserData')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='uniquevalue',
+            index_together=set([('event', 'name', 'value')]),
+        ),
+        migrations.RunPython(backfill_unique_values, remove_unique_values),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_uniquevalue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CensusJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('status', models.CharField(default='pending', max_length=15, choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('error', 'error')])),
+                ('content_type', models.CharField(max_length=255)),
+                ('validation', models.BooleanField(default=True)),
+                ('payload', models.TextField(blank=True)),
+                ('processed', models.IntegerField(default=0)),
+                ('rejected', models.IntegerField(default=0)),
+                ('errors', jsonfield.fields.JSONField(default=list, blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('event', models.ForeignKey(related_name='census_jobs', to='api.AuthEvent')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
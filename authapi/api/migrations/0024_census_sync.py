@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_censusjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userdata',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, null=True),
+            preserve_default=True,
+        ),
+        migrations.CreateModel(
+            name='CensusRemoval',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('userdata', models.IntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('event', models.ForeignKey(related_name='census_removals', to='api.AuthEvent')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='censusremoval',
+            index_together=set([('event', 'created')]),
+        ),
+    ]
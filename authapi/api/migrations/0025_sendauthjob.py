@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_census_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SendAuthJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('total', models.IntegerField(default=0)),
+                ('chunks', models.IntegerField(default=0)),
+                ('chunks_done', models.IntegerField(default=0)),
+                ('sent', models.IntegerField(default=0)),
+                ('skipped', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('event', models.ForeignKey(related_name='send_auth_jobs', to='api.AuthEvent')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0025_sendauthjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sendauthjob',
+            name='config',
+            field=jsonfield.fields.JSONField(default=dict, blank=True),
+            preserve_default=True,
+        ),
+        migrations.CreateModel(
+            name='Outbox',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('user', models.IntegerField()),
+                ('status', models.CharField(default='queued', max_length=15, choices=[('queued', 'queued'), ('sent', 'sent'), ('skipped', 'skipped'), ('failed', 'failed')])),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('job', models.ForeignKey(related_name='outbox', to='api.SendAuthJob')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='outbox',
+            index_together=set([('job', 'status')]),
+        ),
+    ]
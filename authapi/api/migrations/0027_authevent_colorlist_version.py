@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0026_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='authevent',
+            name='colorlist_version',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+    ]
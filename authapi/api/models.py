@@ -5,9 +5,10 @@ from django.contrib.auth.models import User
 from jsonfield import JSONField
 
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save
 from django.db.models import Q
 from django.conf import settings
+from django.utils import timezone
 from utils import genhmac
 
 
@@ -28,6 +29,8 @@ class AuthEvent(models.Model):
     auth_method_config = JSONField()
     extra_fields = JSONField(blank=True, null=True)
     status = models.CharField(max_length=15, choices=AE_STATUSES, default="notstarted")
+    # incremented on each change of the color list, see authmethods.colorlist
+    colorlist_version = models.IntegerField(default=0)
 
     def serialize(self):
         d = self.serialize_restrict()
@@ -69,6 +72,7 @@ class UserData(models.Model):
     tlf = models.CharField(max_length=20, blank=True, null=True)
     metadata = JSONField(default="{}", blank=True, null=True)
     status = models.CharField(max_length=255, choices=STATUSES, default="act")
+    modified = models.DateTimeField(auto_now=True, db_index=True, null=True)
 
     def get_perms(self, obj, permission, object_id=0):
         q = Q(object_type=obj, perm=permission)
@@ -103,8 +107,175 @@ class UserData(models.Model):
 
 @receiver(post_save, sender=User)
 def create_user_data(sender, instance, created, *args, **kwargs):
-    ud, _ = UserData.objects.get_or_create(user=instance)
-    ud.save()
+    # the caller creates the userdata itself, see authmethods.utils.create_user
+    if getattr(instance, 'skip_userdata', False):
+        return
+    UserData.objects.get_or_create(user=instance)
+
+
+# fields of the user that are part of the census
+CENSUS_USER_FIELDS = ('username', 'email')
+
+
+def census_user_fields(user):
+    # deferred fields aren't loaded, they are None
+    return tuple(user.__dict__.get(f) for f in CENSUS_USER_FIELDS)
+
+
+@receiver(post_init, sender=User)
+def load_census_user_fields(sender, instance, **kwargs):
+    instance._census_fields = census_user_fields(instance)
+
+
+@receiver(post_save, sender=User)
+def touch_user_data(sender, instance, created, update_fields, **kwargs):
+    '''
+    The username and email are part of the census, so a change of them is
+    a change of the userdata for the census ETag and sync. Other saves,
+    like the logins, don't touch it.
+    '''
+    fields = census_user_fields(instance)
+    if created or fields == instance._census_fields:
+        return
+    instance._census_fields = fields
+    UserData.objects.filter(user=instance).update(modified=timezone.now())
+
+
+class UniqueValue(models.Model):
+    '''
+    Value of a unique extra field of a user. The table is indexed by
+    (event, name, value), so checking if a value is already used in an auth
+    event is a single lookup instead of a scan of the users metadata.
+    '''
+    user = models.ForeignKey(UserData, related_name="unique_values")
+    event = models.ForeignKey(AuthEvent, related_name="unique_values")
+    name = models.CharField(max_length=255)
+    value = models.CharField(max_length=255)
+
+    class Meta:
+        index_together = [['event', 'name', 'value']]
+
+    def __str__(self):
+        return "%s - %s - %s" % (self.event_id, self.name, self.value)
+
+
+class CensusRemoval(models.Model):
+    '''
+    Voter removed from the census of an auth event, so the incremental
+    census sync can report it after its userdata is deleted.
+    '''
+    event = models.ForeignKey(AuthEvent, related_name="census_removals")
+    userdata = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = [['event', 'created']]
+
+    def __str__(self):
+        return "%s - %s" % (self.event_id, self.userdata)
+
+
+JOB_STATUSES = (
+    ('pending', 'pending'),
+    ('running', 'running'),
+    ('done', 'done'),
+    ('error', 'error'),
+)
+
+class CensusJob(models.Model):
+    '''
+    Census import running in background. The payload is the census as it was
+    uploaded, in json, NDJSON or CSV depending on the content_type, and it's
+    removed once the import finishes.
+    '''
+    event = models.ForeignKey(AuthEvent, related_name="census_jobs")
+    status = models.CharField(max_length=15, choices=JOB_STATUSES, default="pending")
+    content_type = models.CharField(max_length=255)
+    validation = models.BooleanField(default=True)
+    payload = models.TextField(blank=True)
+    processed = models.IntegerField(default=0)
+    rejected = models.IntegerField(default=0)
+    errors = JSONField(default=list, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def serialize(self):
+        d = {
+            'id': self.id,
+            'status': self.status,
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'created': self.created.isoformat(),
+            'modified': self.modified.isoformat(),
+        }
+        return d
+
+    def __str__(self):
+        return "%s - %s - %s" % (self.id, self.event_id, self.status)
+
+
+class SendAuthJob(models.Model):
+    '''
+    Sending of the auth codes to the census of an auth event. The census is
+    split in chunks sent by parallel celery tasks, and each task adds its
+    results to the job when it finishes. The state of each recipient is kept
+    in the outbox, so the job can be resumed.
+    '''
+    event = models.ForeignKey(AuthEvent, related_name="send_auth_jobs")
+    config = JSONField(default=dict, blank=True)
+    total = models.IntegerField(default=0)
+    chunks = models.IntegerField(default=0)
+    chunks_done = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    skipped = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def serialize(self):
+        d = {
+            'id': self.id,
+            'status': 'done' if self.chunks_done >= self.chunks else 'running',
+            'total': self.total,
+            'chunks': self.chunks,
+            'chunks_done': self.chunks_done,
+            'sent': self.sent,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'queued': self.total - self.sent - self.skipped - self.failed,
+            'created': self.created.isoformat(),
+            'modified': self.modified.isoformat(),
+        }
+        return d
+
+    def __str__(self):
+        return "%s - %s - %s/%s" % (self.id, self.event_id, self.chunks_done, self.chunks)
+
+
+OUTBOX_STATUSES = (
+    ('queued', 'queued'),
+    ('sent', 'sent'),
+    ('skipped', 'skipped'),
+    ('failed', 'failed'),
+)
+
+class Outbox(models.Model):
+    '''
+    Recipient of a send auth job, given its user id. It's queued when the
+    job is created, and it's marked as sent, skipped or failed once its
+    chunk is sent, so a resumed job only sends to the queued recipients.
+    '''
+    job = models.ForeignKey(SendAuthJob, related_name="outbox")
+    user = models.IntegerField()
+    status = models.CharField(max_length=15, choices=OUTBOX_STATUSES, default="queued")
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        index_together = [['job', 'status']]
+
+    def __str__(self):
+        return "%s - %s - %s" % (self.job_id, self.user, self.status)
 
 
 class ACL(models.Model):
@@ -1,12 +1,22 @@
+import csv
+import json
+import logging
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.mail import send_mail
+from django.db.models import F
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from djcelery import celery
 
 import plugins
+from authmethods import auth_census_chunks
+from authmethods.census import chunks, csv_census, ndjson_census
 from authmethods.sms_provider import SMSProvider
-from .models import AuthEvent, ACL
-from utils import send_codes
+from .models import AuthEvent, ACL, CensusJob, Outbox, SendAuthJob
+from utils import send_codes_status
+
+logger = logging.getLogger(__name__)
 
 
 def census_send_auth_task(pk, config=None, userids=None):
@@ -22,7 +32,7 @@ def census_send_auth_task(pk, config=None, userids=None):
     census = []
     if userids is None:
         census = ACL.objects.filter(perm="vote", object_type="AuthEvent", object_id=str(pk))
-        census = [i.user.user.id for i in census]
+        census = list(census.values_list('user__user_id', flat=True))
     else:
         census = userids
 
@@ -30,4 +40,124 @@ def census_send_auth_task(pk, config=None, userids=None):
       msg = plugins.call("extend_send_sms", e, len(census))
       if msg:
           return msg
-    send_codes.apply_async(args=[census, config])
+
+    # the census is queued in the outbox, and sent in chunks by parallel tasks
+    job = SendAuthJob.objects.create(event=e, total=len(census), config=config or {})
+    for chunk in chunks(census, settings.SEND_CODES_CHUNK):
+        Outbox.objects.bulk_create([Outbox(job=job, user=user) for user in chunk])
+    send_queued(job, census)
+
+
+def resume_send_auth_job(job, retry_failed=False):
+    """
+    Sends the codes to the recipients of the job still queued in the outbox,
+    like the ones of a chunk whose worker died, and also to the failed ones
+    if retry_failed. Returns the number of recipients to send.
+    """
+
+    outbox = job.outbox.all()
+    if retry_failed:
+        failed = outbox.filter(status='failed').update(status='queued')
+        SendAuthJob.objects.filter(pk=job.pk).update(failed=F('failed') - failed)
+    users = list(outbox.filter(status='queued').values_list('user', flat=True))
+    send_queued(job, users)
+    return len(users)
+
+
+def send_queued(job, users):
+    """
+    Sends the chunks of the queued users of the job. The chunks not done
+    yet are replaced by the new ones in the job progress.
+    """
+
+    size = settings.SEND_CODES_CHUNK
+    SendAuthJob.objects.filter(pk=job.pk).update(
+        chunks=F('chunks_done') + (len(users) + size - 1) // size)
+    for chunk in chunks(users, size):
+        send_codes_chunk.apply_async(args=[job.pk, chunk, job.config or None])
+
+
+@celery.task(acks_late=True)
+def send_codes_chunk(job_id, users, config=None):
+    """
+    Sends the codes to the users of a chunk still queued in the outbox, in
+    batches of settings.SEND_CODES_BATCH users, saving the status of each
+    user and adding the results to the job after each batch. The users
+    already sent are skipped, so if the task is run again only the batch
+    that was being sent is sent again.
+    """
+
+    outbox = Outbox.objects.filter(job_id=job_id, status='queued')
+    queued = list(outbox.filter(user__in=users).values_list('user', flat=True))
+    for batch in chunks(queued, settings.SEND_CODES_BATCH):
+        statuses = send_codes_status(batch, config)
+
+        # deleted users are skipped
+        result = {'sent': [], 'skipped': [], 'failed': []}
+        for user in batch:
+            result[statuses.get(user, 'skipped')].append(user)
+        for status, batch_users in result.items():
+            if batch_users:
+                outbox.filter(user__in=batch_users).update(status=status)
+
+        SendAuthJob.objects.filter(pk=job_id).update(
+            sent=F('sent') + len(result['sent']),
+            skipped=F('skipped') + len(result['skipped']),
+            failed=F('failed') + len(result['failed']),
+            modified=timezone.now())
+
+    SendAuthJob.objects.filter(pk=job_id).update(
+        chunks_done=F('chunks_done') + 1, modified=timezone.now())
+
+
+def job_census(job):
+    """
+    Returns the census rows of the job payload, read depending on its
+    content type. A json payload is the same as in POST census, so it also
+    gives the field validation.
+    """
+
+    if job.content_type == 'application/x-ndjson':
+        return ndjson_census(job.payload.splitlines())
+    elif job.content_type == 'text/csv':
+        return csv_census(job.event, job.payload.splitlines())
+
+    req = json.loads(job.payload)
+    job.validation = req.get('field-validation', 'enabled') == 'enabled'
+    return req.get('census') or []
+
+
+# errors raised reading and checking malformed census rows, like bad json,
+# csv or ints, or rows that aren't objects
+INVALID_CENSUS = (ValueError, TypeError, AttributeError, KeyError, csv.Error)
+
+@celery.task
+def census_import_task(job_id):
+    """
+    Imports the census of a job in chunks, saving the progress of the job
+    after each chunk
+    """
+
+    job = CensusJob.objects.get(pk=job_id)
+    job.status = 'running'
+    job.save()
+
+    try:
+        rows = job_census(job)
+        for chunk in auth_census_chunks(job.event, rows, job.validation):
+            job.processed += chunk['rows']
+            job.rejected += chunk['rows'] - chunk['created']
+            if 'msg' in chunk and len(job.errors) < settings.CENSUS_JOB_MAX_ERRORS:
+                job.errors.append({'chunk': chunk['chunk'], 'msg': chunk['msg']})
+            job.save()
+        job.status = 'done'
+    except INVALID_CENSUS:
+        job.status = 'error'
+        job.errors.append({'msg': 'Invalid census data after row %d' % job.processed})
+    except Exception:
+        logger.exception("error importing the census of job %d", job.pk)
+        job.status = 'error'
+        job.errors.append({'msg': 'Internal error after row %d' % job.processed})
+
+    job.payload = ''
+    job.save()
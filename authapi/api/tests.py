@@ -1,17 +1,36 @@
 import time
 import json
+import multiprocessing
+from unittest.mock import patch
+from urllib.parse import quote
+from datetime import timedelta
 from django.core import mail
 from django.test import TestCase
 from django.test import Client
-from django.test.utils import override_settings
+from django.test.signals import setting_changed
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection
+from django.dispatch import receiver
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from . import test_data
-from .models import ACL, AuthEvent
+from .models import ACL, AuthEvent, CensusJob, CensusRemoval, Outbox, SendAuthJob, UniqueValue
+from .tasks import census_import_task, send_codes_chunk
 from authmethods.models import Code
-from utils import verifyhmac
-from authmethods.utils import get_cannonical_tlf
+from utils import send_codes_status, send_user_codes, verifyhmac
+from authmethods.registry import REGISTRIES
+from authmethods.utils import get_cannonical_tlf, reindex_unique_values
+
+
+@receiver(setting_changed)
+def reset_registries(setting, **kwargs):
+    ''' The providers and backends are built again with the new settings '''
+    for registry in REGISTRIES:
+        registry.reset()
+
 
 class JClient(Client):
     def __init__(self, *args, **kwargs):
@@ -29,8 +48,8 @@ class JClient(Client):
         self.set_auth_token(r.get('auth-token'))
         return response
 
-    def authenticate(self, authevent, data):
-        response = self.post('/api/auth-event/%d/authenticate/' % authevent, data)
+    def authenticate(self, authevent, data, **extra):
+        response = self.post('/api/auth-event/%d/authenticate/' % authevent, data, **extra)
         r = json.loads(response.content.decode('utf-8'))
         self.set_auth_token(r.get('auth-token'))
         return response
@@ -38,14 +57,14 @@ class JClient(Client):
     def set_auth_token(self, token):
         self.auth_token = token
 
-    def get(self, url, data):
+    def get(self, url, data, **extra):
         return super(JClient, self).get(url, data,
-            content_type="application/json", HTTP_AUTH=self.auth_token)
+            content_type="application/json", HTTP_AUTH=self.auth_token, **extra)
 
-    def post(self, url, data):
+    def post(self, url, data, **extra):
         jdata = json.dumps(data)
         return super(JClient, self).post(url, jdata,
-            content_type="application/json", HTTP_AUTH=self.auth_token)
+            content_type="application/json", HTTP_AUTH=self.auth_token, **extra)
 
     def put(self, url, data):
         jdata = json.dumps(data)
@@ -642,7 +661,7 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 4)
 
     def test_add_census_authevent_email_fields(self):
@@ -651,6 +670,210 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         response = c.census(self.aeid, test_data.census_email_fields)
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(CENSUS_IMPORT_CHUNK=3)
+    def test_add_census_authevent_email_chunks(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = {
+            "field-validation": "enabled",
+            "census": [{"name": "n%d" % i, "email": "c%d@aaa.com" % i} for i in range(7)]
+        }
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+
+        for i in range(7):
+            u = User.objects.get(email="c%d@aaa.com" % i)
+            self.assertEqual(u.userdata.event, self.ae)
+            self.assertEqual(json.loads(u.userdata.metadata), {"name": "n%d" % i})
+            self.assertTrue(u.userdata.has_perms('UserData', 'edit', u.pk))
+            self.assertTrue(u.userdata.has_perms('AuthEvent', 'vote', self.aeid))
+
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 400)
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertTrue(r['msg'].count("Email c6@aaa.com repeat."))
+
+    @override_settings(CENSUS_EXPORT_CHUNK=3)
+    def test_get_census_authevent_email_compact(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = {"census": [{"name": "n%d" % i, "email": "c%d@aaa.com" % i} for i in range(7)]}
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+
+        response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
+        self.assertEqual(response.status_code, 200)
+        # three chunks and the last empty one for each section
+        with self.assertNumQueries(4 * 4):
+            full = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(len(full['userids']), 7)
+
+        response = c.get('/api/auth-event/%d/census/?compact' % self.aeid, {})
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(4):
+            r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(r, {'object_list': full['object_list']})
+        for voter in r['object_list']:
+            u = User.objects.get(pk=voter['id'])
+            self.assertEqual(voter['username'], u.username)
+            self.assertEqual(voter['metadata'], full['data'][u.username])
+            self.assertEqual(full['users'][u.username], u.email)
+            self.assertEqual(voter['metadata'], {'email': u.email, 'name': json.loads(u.userdata.metadata)['name']})
+
+    def test_get_census_authevent_email_since(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = {"census": [{"name": "n%d" % i, "email": "c%d@aaa.com" % i} for i in range(3)]}
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+
+        url = '/api/auth-event/%d/census/' % self.aeid
+        with self.settings(CENSUS_CURSOR_MARGIN=0):
+            response = c.get(url, {})
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        cursor = response['X-Census-Cursor']
+        response = c.get(url, {}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = c.get(url + '?since=%s' % quote(cursor), {})
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(r, {'object_list': [], 'removed': []})
+
+        changed = User.objects.get(email="c0@aaa.com").userdata
+        changed.metadata = json.dumps({"name": "changed"})
+        changed.save()
+        removed = User.objects.get(email="c1@aaa.com").userdata
+        response = c.post('/api/auth-event/%d/census/delete/' % self.aeid,
+                          {'user-ids': [removed.user.pk]})
+        self.assertEqual(response.status_code, 200)
+        response = c.census(self.aeid, {"census": [{"email": "new@aaa.com"}]})
+        self.assertEqual(response.status_code, 200)
+
+        response = c.get(url, {}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        response = c.get(url + '?since=%s' % quote(cursor), {})
+        self.assertEqual(response.status_code, 200)
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(sorted(v['metadata']['email'] for v in r['object_list']),
+                         ['c0@aaa.com', 'new@aaa.com'])
+        self.assertEqual(r['removed'], [removed.pk])
+        self.assertEqual(CensusRemoval.objects.filter(event=self.ae).count(), 1)
+
+        response = c.get(url + '?since=yesterday', {})
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_census_authevent_email_since_user_changes(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = {"census": [{"email": "c%d@aaa.com" % i} for i in range(2)]}
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+
+        url = '/api/auth-event/%d/census/' % self.aeid
+        with self.settings(CENSUS_CURSOR_MARGIN=0):
+            response = c.get(url, {})
+        etag = response['ETag']
+        cursor = response['X-Census-Cursor']
+
+        # saves that don't change the census don't change the ETag
+        user = User.objects.get(email="c0@aaa.com")
+        user.first_name = "c0"
+        user.save()
+        response = c.get(url, {}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # user changed out of the census endpoints, and user removed
+        user.email = "changed@aaa.com"
+        user.save()
+        removed = User.objects.get(email="c1@aaa.com")
+        udid = removed.userdata.pk
+        response = c.post(url + 'delete/', {'user-ids': [removed.pk]})
+        self.assertEqual(response.status_code, 200)
+
+        response = c.get(url, {}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        response = c.get(url + '?since=%s' % quote(cursor), {})
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([v['metadata']['email'] for v in r['object_list']], ['changed@aaa.com'])
+        self.assertEqual(r['removed'], [udid])
+
+    def test_get_census_authevent_email_cursor_margin(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        url = '/api/auth-event/%d/census/' % self.aeid
+        margin = timedelta(seconds=settings.CENSUS_CURSOR_MARGIN)
+        before = timezone.now()
+        response = c.get(url, {})
+        after = timezone.now()
+        cursor = parse_datetime(response['X-Census-Cursor'])
+        self.assertTrue(before - margin <= cursor <= after - margin)
+
+    def test_delete_census_authevent_email(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = {"census": [{"email": "c%d@aaa.com" % i} for i in range(35)]}
+        census['census'][0]['status'] = 'used'
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+        url = '/api/auth-event/%d/census/delete/' % self.aeid
+
+        ids = [User.objects.get(email="c%d@aaa.com" % i).pk for i in range(35)]
+        response = c.post(url, {'user-ids': ids[1:3] + [0]})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(User.objects.filter(pk__in=ids).count(), 35)
+
+        # the queries don't grow with the number of users deleted
+        queries = []
+        for delete in (ids[1:4], ids[4:34]):
+            with CaptureQueriesContext(connection) as context:
+                response = c.post(url, {'user-ids': delete})
+            self.assertEqual(response.status_code, 200)
+            r = json.loads(response.content.decode('utf-8'))
+            self.assertEqual(r, {'status': 'ok', 'deleted': len(delete)})
+            queries.append(len(context))
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(User.objects.filter(pk__in=ids).count(), 2)
+        self.assertEqual(CensusRemoval.objects.filter(event=self.ae).count(), 33)
+
+        response = c.post(url, {'filter': {'is_active': False}})
+        self.assertEqual(response.status_code, 200)
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(r['deleted'], 1)
+        self.assertEqual(list(User.objects.filter(pk__in=ids).values_list('pk', flat=True)), ids[:1])
+        self.assertTrue(User.objects.filter(pk=self.uid_admin).exists())
+
+        response = c.post(url, {'filter': {'email': 'c0@aaa.com'}})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(CENSUS_HASH_PROCESSES=2)
+    def test_add_census_authevent_email_passwords(self):
+        self.ae.extra_fields = [{"name": "pwd", "type": "password"}]
+        self.ae.save()
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = {
+            "field-validation": "disabled",
+            "census": [{"pwd": "p%d" % i, "email": "c%d@aaa.com" % i} for i in range(3)]
+        }
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+
+        for i in range(3):
+            u = User.objects.get(email="c%d@aaa.com" % i)
+            self.assertTrue(u.check_password("p%d" % i))
+            self.assertFalse(u.check_password("p%d" % (i + 1)))
+            self.assertEqual(json.loads(u.userdata.metadata), {})
+
+    def test_add_census_authevent_email_passwords_worker(self):
+        # celery workers are daemon processes, so the passwords are hashed
+        # in the import task
+        process = multiprocessing.current_process()
+        process.daemon = True
+        try:
+            self.test_add_census_authevent_email_passwords()
+        finally:
+            process.daemon = False
+
     def test_add_census_authevent_email_default_incorrect(self):
         c = JClient()
         c.authenticate(0, test_data.admin)
@@ -682,7 +905,7 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 0)
         response = c.register(self.aeid, test_data.census_email_default_used['census'][1])
         self.assertEqual(response.status_code, 400)
@@ -785,6 +1008,135 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         response = c.post('/api/auth-event/%d/census/send_auth/' % self.aeid, tpl_specific)
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
+                       CELERY_ALWAYS_EAGER=True,
+                       BROKER_BACKEND='memory',
+                       SEND_CODES_CHUNK=2)
+    def test_send_auth_email_chunks(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = {"census": [{"email": "c%d@aaa.com" % i} for i in range(5)]}
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+        mail.outbox = []
+        response = c.post('/api/auth-event/%d/census/send_auth/' % self.aeid, {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 5)
+
+        response = c.get('/api/auth-event/%d/census/send_auth/' % self.aeid, {})
+        self.assertEqual(response.status_code, 200)
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(r['jobs']), 1)
+        job = r['jobs'][0]
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual([job['total'], job['chunks'], job['chunks_done']], [5, 3, 3])
+        self.assertEqual([job['sent'], job['skipped'], job['failed']], [5, 0, 0])
+
+    @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
+                       CELERY_ALWAYS_EAGER=True,
+                       BROKER_BACKEND='memory',
+                       SEND_CODES_CHUNK=2)
+    def test_send_auth_resume(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = {"census": [{"email": "c%d@aaa.com" % i} for i in range(5)]}
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+        response = c.post('/api/auth-event/%d/census/send_auth/' % self.aeid, {})
+        self.assertEqual(response.status_code, 200)
+        job = SendAuthJob.objects.get(event_id=self.aeid)
+        self.assertEqual(job.outbox.filter(status='sent').count(), 5)
+
+        # the worker of the last chunk died, and one email failed
+        ids = [User.objects.get(email="c%d@aaa.com" % i).pk for i in range(5)]
+        job.outbox.filter(user__in=ids[3:]).update(status='queued')
+        job.outbox.filter(user=ids[0]).update(status='failed')
+        SendAuthJob.objects.filter(pk=job.pk).update(chunks_done=2, sent=2, failed=1)
+
+        mail.outbox = []
+        url = '/api/auth-event/%d/census/send_auth/%d/resume/' % (self.aeid, job.pk)
+        response = c.post(url, {})
+        self.assertEqual(response.status_code, 200)
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(r['queued'], 2)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['c3@aaa.com', 'c4@aaa.com'])
+        job = SendAuthJob.objects.get(pk=job.pk).serialize()
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual([job['sent'], job['failed'], job['queued']], [4, 1, 0])
+
+        mail.outbox = []
+        response = c.post(url, {'retry-failed': True})
+        self.assertEqual(response.status_code, 200)
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(r['queued'], 1)
+        self.assertEqual([m.to[0] for m in mail.outbox], ['c0@aaa.com'])
+        job = SendAuthJob.objects.get(pk=job['id']).serialize()
+        self.assertEqual([job['sent'], job['failed'], job['queued']], [5, 0, 0])
+
+        c = JClient()
+        response = c.post(url, {})
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(SEND_CODES_BATCH=2)
+    def test_send_codes_chunk_batches(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = {"census": [{"email": "c%d@aaa.com" % i} for i in range(5)]}
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+        ids = [User.objects.get(email="c%d@aaa.com" % i).pk for i in range(5)]
+        job = SendAuthJob.objects.create(event=self.ae, total=5, chunks=1)
+        Outbox.objects.bulk_create([Outbox(job=job, user=user) for user in ids])
+
+        # the worker dies after sending the first batch
+        calls = []
+        def dying(users, config=None):
+            calls.append(users)
+            if len(calls) > 1:
+                raise SystemExit()
+            return send_codes_status(users, config)
+
+        mail.outbox = []
+        with patch('api.tasks.send_codes_status', dying):
+            self.assertRaises(SystemExit, send_codes_chunk, job.pk, ids)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(job.outbox.filter(status='sent').count(), 2)
+        job = SendAuthJob.objects.get(pk=job.pk)
+        self.assertEqual([job.sent, job.chunks_done], [2, 0])
+
+        # the chunk is delivered again, and only the rest is sent
+        send_codes_chunk(job.pk, ids)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ["c%d@aaa.com" % i for i in range(5)])
+        job = SendAuthJob.objects.get(pk=job.pk)
+        self.assertEqual([job.sent, job.chunks_done], [5, 1])
+
+    def test_send_user_codes_email(self):
+        admin = User.objects.get(pk=self.uid_admin)
+        admin.email = 'admin@aaa.com'
+        admin.save()
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = {"census": [{"email": "c%d@aaa.com" % i} for i in range(5)]}
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+        ids = [User.objects.get(email="c%d@aaa.com" % i).pk for i in range(5)]
+        User.objects.filter(pk=ids[0]).update(email='')
+
+        queries = []
+        for users in (ids[:2], ids):
+            mail.outbox = []
+            with CaptureQueriesContext(connection) as context:
+                r = send_user_codes(users)
+            queries.append(len(context))
+            self.assertEqual(r, {'sent': len(users) - 1, 'skipped': 1, 'failed': 0})
+            self.assertEqual(len(mail.outbox), len(users) - 1)
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(mail.outbox[0].extra_headers, {'Reply-To': 'admin@aaa.com'})
+        self.assertEqual(Code.objects.filter(user__user_id__in=ids).count(), 1 + 4)
+        code = Code.objects.filter(user__user__email='c4@aaa.com').first()
+        self.assertTrue(code.code in mail.outbox[-1].body)
+
     def test_unique_field(self):
         self.ae.extra_fields = test_data.extra_field_unique
         self.ae.save()
@@ -795,7 +1147,7 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 2)
 
         self.assertEqual(Code.objects.count(), 1)
@@ -812,6 +1164,30 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         self.assertTrue(r['msg'].count("Maximun number of codes sent"))
         self.assertTrue(r['msg'].count("dni %s repeat." % user['dni']))
 
+    def test_unique_field_values(self):
+        self.ae.extra_fields = test_data.extra_field_unique
+        self.ae.save()
+
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        response = c.census(self.aeid, test_data.census_email_unique_dni)
+        self.assertEqual(response.status_code, 200)
+        dnis = [r['dni'] for r in test_data.census_email_unique_dni['census']]
+        values = UniqueValue.objects.filter(event=self.ae, name='dni')
+        self.assertEqual(sorted(v.value for v in values), [json.dumps(d) for d in dnis])
+
+        u = User.objects.get(email=test_data.census_email_unique_dni['census'][0]['email'])
+        u.delete()
+        self.assertEqual(UniqueValue.objects.filter(event=self.ae).count(), 1)
+        response = c.census(self.aeid, {"census": [{"dni": dnis[0], "email": "new@aaa.com"}]})
+        self.assertEqual(response.status_code, 200)
+        response = c.census(self.aeid, {"census": [{"dni": dnis[1], "email": "new2@aaa.com"}]})
+        self.assertEqual(response.status_code, 400)
+
+        UniqueValue.objects.filter(event=self.ae).delete()
+        reindex_unique_values(self.ae)
+        self.assertEqual(UniqueValue.objects.filter(event=self.ae).count(), 2)
+
 
     @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
                        CELERY_ALWAYS_EAGER=True,
@@ -824,7 +1200,7 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         c.authenticate(0, test_data.admin)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 0)
 
         test_data.census_email_repeat['field-validation'] = 'disabled'
@@ -832,14 +1208,14 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 1)
 
         response = c.census(self.aeid, test_data.census_email_no_validate)
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 1 + 6)
 
         self.assertEqual(Code.objects.count(), 1)
@@ -899,6 +1275,87 @@ class TestRegisterAndAuthenticateSMS(TestCase):
         response = c.census(self.aeid, test_data.census_sms_fields)
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(CENSUS_IMPORT_CHUNK=2)
+    def test_add_census_stream_ndjson(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = test_data.census_sms_default['census'] + [{"tlf": "666666670"}]
+        body = '\n'.join(json.dumps(r) for r in census)
+        response = c.generic('POST', '/api/auth-event/%d/census/stream/' % self.aeid,
+            body, content_type='application/x-ndjson', HTTP_AUTH=c.auth_token)
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        progress = [json.loads(l) for l in lines]
+        self.assertEqual([p['status'] for p in progress], ['ok', 'ok', 'nok', 'ok'])
+        self.assertEqual(progress[2]['msg'], 'Tel +34666666670 repeat.')
+        self.assertEqual(progress[-1], {'status': 'ok', 'rows': 5, 'created': 4})
+        self.assertEqual(ACL.objects.filter(perm='vote', object_id=self.aeid).count(), 4)
+
+    @override_settings(CENSUS_IMPORT_CHUNK=2)
+    def test_add_census_stream_csv(self):
+        self.ae.extra_fields = test_data.auth_event2['extra_fields']
+        self.ae.save()
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        body = ('tlf,name,age,email,dni\n'
+                '666666667,aaaa,20,a@aaa.com,11111111H\n'
+                '666666668,,30,b@aaa.com,22222222J\n'
+                '666666669,cccc,10,c@aaa.com,11111111H\n')
+        response = c.generic('POST', '/api/auth-event/%d/census/stream/?field-validation=enabled' % self.aeid,
+            body, content_type='text/csv', HTTP_AUTH=c.auth_token)
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        progress = [json.loads(l) for l in lines]
+        self.assertEqual([p['created'] for p in progress], [2, 0, 2])
+        u = User.objects.get(userdata__tlf='+34666666668')
+        self.assertEqual(json.loads(u.userdata.metadata), {'age': 30, 'dni': '22222222J'})
+        self.assertEqual(u.email, 'b@aaa.com')
+
+    @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
+                       CELERY_ALWAYS_EAGER=True,
+                       BROKER_BACKEND='memory',
+                       CENSUS_IMPORT_CHUNK=2)
+    def test_add_census_async(self):
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        census = dict(test_data.census_sms_default)
+        census['census'] = census['census'] + [{"tlf": "666666670"}]
+        response = c.post('/api/auth-event/%d/census/?async=true' % self.aeid, census)
+        self.assertEqual(response.status_code, 202)
+        job = json.loads(response.content.decode('utf-8'))['job']
+
+        response = c.get('/api/auth-event/%d/census/job/%d/' % (self.aeid, job), {})
+        self.assertEqual(response.status_code, 200)
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(r['status'], 'done')
+        self.assertEqual(r['processed'], 5)
+        self.assertEqual(r['rejected'], 1)
+        self.assertEqual(r['errors'], [{'chunk': 2, 'msg': 'Tel +34666666670 repeat.'}])
+        self.assertEqual(ACL.objects.filter(perm='vote', object_id=self.aeid).count(), 4)
+        self.assertEqual(CensusJob.objects.get(pk=job).payload, '')
+
+        c = JClient()
+        response = c.get('/api/auth-event/%d/census/job/%d/' % (self.aeid, job), {})
+        self.assertEqual(response.status_code, 403)
+
+    def test_census_import_task_errors(self):
+        job = CensusJob.objects.create(event=self.ae, content_type='application/x-ndjson',
+                                       payload='{"tlf": "666666670"}\n{bad')
+        census_import_task(job.pk)
+        job = CensusJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, 'error')
+        self.assertEqual(job.errors, [{'msg': 'Invalid census data after row 0'}])
+
+        # the errors that aren't of the census data aren't blamed on it
+        job = CensusJob.objects.create(event=self.ae, content_type='application/x-ndjson',
+                                       payload='{"tlf": "666666670"}')
+        with patch('api.tasks.auth_census_chunks', side_effect=RuntimeError()):
+            with self.assertLogs('api.tasks', 'ERROR'):
+                census_import_task(job.pk)
+        job = CensusJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, 'error')
+        self.assertEqual(job.errors, [{'msg': 'Internal error after row 0'}])
+
     def test_add_census_authevent_sms_repeat(self):
         c = JClient()
         c.authenticate(0, test_data.admin)
@@ -914,7 +1371,7 @@ class TestRegisterAndAuthenticateSMS(TestCase):
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 0)
         response = c.register(self.aeid, test_data.census_sms_default_used['census'][1])
         self.assertEqual(response.status_code, 400)
@@ -1072,7 +1529,7 @@ class TestRegisterAndAuthenticateSMS(TestCase):
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/?validate' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 2)
 
         self.assertEqual(Code.objects.count(), 1)
@@ -1101,7 +1558,7 @@ class TestRegisterAndAuthenticateSMS(TestCase):
         c.authenticate(0, test_data.admin)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 0)
 
         test_data.census_sms_repeat['field-validation'] = 'disabled'
@@ -1109,14 +1566,14 @@ class TestRegisterAndAuthenticateSMS(TestCase):
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 1)
 
         response = c.census(self.aeid, test_data.census_sms_no_validate)
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 1 + 4)
 
         self.assertEqual(Code.objects.count(), 1)
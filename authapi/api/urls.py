@@ -11,10 +11,13 @@ urlpatterns = patterns('',
     url(r'^auth-event/(?P<pk>\d+)/$', 'api.views.authevent', name='authevent'),
     url(r'^auth-event/(?P<pk>\d+)/census/$', 'api.views.census', name='census'),
     url(r'^auth-event/(?P<pk>\d+)/census/delete/$', 'api.views.census_delete', name='census_delete'),
+    url(r'^auth-event/(?P<pk>\d+)/census/stream/$', 'api.views.census_stream', name='census_stream'),
+    url(r'^auth-event/(?P<pk>\d+)/census/job/(?P<job>\d+)/$', 'api.views.census_job', name='census_job'),
     url(r'^auth-event/(?P<pk>\d+)/ping/$', 'api.views.ping', name='ping'),
     url(r'^auth-event/(?P<pk>\d+)/register/$', 'api.views.register', name='register'),
     url(r'^auth-event/(?P<pk>\d+)/authenticate/$', 'api.views.authenticate', name='authenticate'),
     url(r'^auth-event/(?P<pk>\d+)/census/send_auth/$', 'api.views.census_send_auth', name='census_send_auth'),
+    url(r'^auth-event/(?P<pk>\d+)/census/send_auth/(?P<job>\d+)/resume/$', 'api.views.census_send_auth_resume', name='census_send_auth_resume'),
     url(r'^auth-event/(?P<pk>\d+)/(?P<status>(notstarted|started|stopped))/$', 'api.views.ae_status', name='ae_status'),
     url(r'^auth-event/module/$', 'api.views.authevent_module', name='authevent_module'),
     url(r'^auth-event/module/(?P<name>[-\w]+)/$', 'api.views.authevent_module', name='authevent_module'),
@@ -1,7 +1,19 @@
+import hashlib
 import json
+from datetime import timedelta
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.db import transaction
+from django.db.models import Count, Max
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseNotModified,
+    StreamingHttpResponse,
+)
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.views.generic import View
 from django.shortcuts import get_object_or_404
 
@@ -9,10 +21,13 @@ import plugins
 from authmethods import (
     auth_authenticate,
     auth_census,
+    auth_census_chunks,
     auth_register,
     check_config,
     METHODS,
 )
+from authmethods.census import chunks, csv_census, ndjson_census
+from authmethods.utils import AuthContext
 from utils import (
     check_authmethod,
     check_extra_fields,
@@ -26,9 +41,9 @@ from utils import (
     VALID_PIPELINES,
 )
 from .decorators import login_required, get_login_user
-from .models import AuthEvent, ACL
+from .models import AuthEvent, ACL, CensusJob, CensusRemoval, SendAuthJob
 from .models import User, UserData
-from .tasks import census_send_auth_task
+from .tasks import census_import_task, census_send_auth_task, resume_send_auth_job
 from django.db.models import Q
 from captcha.views import generate_captcha
 
@@ -56,25 +71,70 @@ class Test(View):
 test = Test.as_view()
 
 class CensusDelete(View):
-    ''' Delete census in the auth-event '''
+    '''
+    Delete census in the auth-event, given the user ids or a filter of the
+    voters to delete. The users are deleted in chunks of
+    settings.CENSUS_IMPORT_CHUNK with a fixed number of queries.
+    '''
+
+    # voters filters by their name in the request
+    FILTERS = {
+        'is_active': 'is_active',
+    }
+
     def post(self, request, pk):
+        permission_required(request.user, 'AuthEvent', 'edit', pk)
         ae = get_object_or_404(AuthEvent, pk=pk)
         req = json.loads(request.body.decode('utf-8'))
-        for uid in req.get('user-ids'):
-          u = get_object_or_404(User, pk=uid, userdata__event=ae)
-          for acl in u.userdata.acls.all():
-              acl.delete()
-          u.delete()
-        return HttpResponse("ok", status=200, content_type='application/json')
+        users = User.objects.filter(userdata__event=ae)
+        size = settings.CENSUS_IMPORT_CHUNK
+
+        if 'filter' in req:
+            filters = req.get('filter')
+            if not isinstance(filters, dict) or set(filters) - set(self.FILTERS):
+                bad_request = json.dumps({"error": "bad_request"})
+                return HttpResponseBadRequest(bad_request, content_type='application/json')
+            users = users.filter(userdata__acls__object_type='AuthEvent',
+                                 userdata__acls__perm='vote',
+                                 userdata__acls__object_id=pk)
+            users = users.filter(**dict((self.FILTERS[k], v) for k, v in filters.items()))
+            ids = list(users.distinct().values_list('id', 'userdata__id'))
+        else:
+            uids = set(int(uid) for uid in req.get('user-ids'))
+            ids = []
+            for chunk in chunks(uids, size):
+                ids.extend(users.filter(pk__in=chunk).values_list('id', 'userdata__id'))
+            if len(ids) != len(uids):
+                raise Http404
+
+        with transaction.atomic():
+            for chunk in chunks(ids, size):
+                CensusRemoval.objects.bulk_create([
+                    CensusRemoval(event=ae, userdata=udid) for uid, udid in chunk])
+                User.objects.filter(pk__in=[uid for uid, udid in chunk]).delete()
+
+        jsondata = json.dumps({'status': 'ok', 'deleted': len(ids)})
+        return HttpResponse(jsondata, content_type='application/json')
 census_delete = login_required(CensusDelete.as_view())
 
+def census_voter(acl):
+    ''' Voter of the census object_list, given its vote ACL '''
+    return {
+        "id": acl.user.pk,
+        "username": acl.user.user.username,
+        "metadata": acl.user.serialize_data()
+    }
+
+
 class Census(View):
     ''' Add census in the auth-event '''
 
     def post(self, request, pk):
         e = get_object_or_404(AuthEvent, pk=pk)
+        if request.GET.get('async') == 'true':
+            return self.post_async(request, e)
         try:
-            data = auth_census(e, request)
+            data = auth_census(e, AuthContext(request))
         except:
             bad_request = json.dumps({"error": "bad_request"})
             return HttpResponseBadRequest(bad_request, content_type='application/json')
@@ -82,29 +142,167 @@ class Census(View):
         jsondata = json.dumps(data)
         return HttpResponse(jsondata, status=status, content_type='application/json')
 
+    # census sections: name, brackets and the json of each voter
+    SECTIONS = (
+        ('userids', '[]', lambda acl: json.dumps(acl.user.pk)),
+        ('users', '{}', lambda acl: '%s: %s' % (
+            json.dumps(acl.user.user.username), json.dumps(acl.user.user.email))),
+        ('data', '{}', lambda acl: '%s: %s' % (
+            json.dumps(acl.user.user.username), json.dumps(acl.user.serialize_data()))),
+        ('object_list', '[]', lambda acl: json.dumps(census_voter(acl))),
+    )
+
     def get(self, request, pk):
+        '''
+        Streams the census. With ?compact only the object_list is returned,
+        so each voter is sent once instead of once per section. With
+        ?since=<cursor> only the voters added, changed or removed since the
+        cursor are returned. The X-Census-Cursor header has the cursor for
+        the next sync, and the ETag lets unchanged census return a 304.
+        '''
         permission_required(request.user, 'AuthEvent', 'edit', pk)
         e = get_object_or_404(AuthEvent, pk=pk)
+        # rows committed after now with an earlier date aren't missed
+        cursor = timezone.now() - timedelta(seconds=settings.CENSUS_CURSOR_MARGIN)
         acls = ACL.objects.filter(object_type='AuthEvent', perm='vote', object_id=pk)
-        userids = []
+
+        etag = self.etag(e, acls, request.GET.urlencode())
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+
+        if 'since' in request.GET:
+            since = parse_datetime(request.GET['since'])
+            if not since:
+                bad_request = json.dumps({"error": "bad_request"})
+                return HttpResponseBadRequest(bad_request, content_type='application/json')
+            response = HttpResponse(self.changes(e, acls, since), content_type='application/json')
+        else:
+            sections = self.SECTIONS
+            if 'compact' in request.GET:
+                sections = sections[-1:]
+            response = StreamingHttpResponse(self.export(acls, sections), content_type='application/json')
+        response['ETag'] = etag
+        response['X-Census-Cursor'] = cursor.isoformat()
+        return response
+
+    def etag(self, e, acls, query):
+        '''
+        The census changes when a voter is added, changed or removed, so its
+        ETag is built from the number of voters, the last ACL and userdata
+        modification and the last removal.
+        '''
+        state = acls.aggregate(Count('id'), Max('created'), Max('user__modified'))
+        removed = CensusRemoval.objects.filter(event=e).aggregate(Max('id'))
+        state = json.dumps([sorted(state.items(), key=lambda i: i[0]), removed, query], default=str)
+        return '"%s"' % hashlib.md5(state.encode('utf-8')).hexdigest()
+
+    def changes(self, e, acls, since):
+        '''
+        Returns the voters added or changed since the given date, like in the
+        object_list, and the ids of the removed ones
+        '''
+        acls = acls.filter(Q(created__gte=since) | Q(user__modified__gte=since))
         object_list = []
-        users = {}
-        data = {}
-        for acl in acls:
-            userids.append(acl.user.pk)
-            users[acl.user.user.username] = acl.user.user.email
-            metadata = acl.user.serialize_data()
-            data[acl.user.user.username] = metadata
-            object_list.append({
-              "id": acl.user.pk,
-              "username": acl.user.user.username,
-              "metadata": metadata
-            })
-        jsondata = json.dumps({'userids': userids, 'users': users, 'data': data, 'object_list': object_list})
-        return HttpResponse(jsondata, content_type='application/json')
+        for chunk in self.chunks(acls):
+            object_list.extend(census_voter(acl) for acl in chunk)
+        removals = CensusRemoval.objects.filter(event=e, created__gte=since)
+        removed = list(removals.values_list('userdata', flat=True))
+        return json.dumps({'object_list': object_list, 'removed': removed})
+
+    def export(self, acls, sections):
+        '''
+        Yields the census json by parts. Each section is a pass over the
+        voters, read in chunks of settings.CENSUS_EXPORT_CHUNK by id with the
+        user and userdata joined, so the census is never fully in memory.
+        '''
+        yield '{'
+        for n, (name, brackets, voter) in enumerate(sections):
+            yield '%s"%s": %s' % (', ' if n else '', name, brackets[0])
+            sep = ''
+            for chunk in self.chunks(acls):
+                yield sep + ', '.join(voter(acl) for acl in chunk)
+                sep = ', '
+            yield brackets[1]
+        yield '}'
+
+    def chunks(self, acls):
+        last = 0
+        size = settings.CENSUS_EXPORT_CHUNK
+        acls = acls.select_related('user__user').order_by('id')
+        while True:
+            chunk = list(acls.filter(id__gt=last)[:size])
+            if not chunk:
+                return
+            yield chunk
+            last = chunk[-1].id
+
+    def post_async(self, request, e):
+        '''
+        Stores the census in a job and imports it in background, returning
+        the job id to follow its progress
+        '''
+        permission_required(request.user, 'AuthEvent', 'edit', e.pk)
+        content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+        if content_type not in ('application/x-ndjson', 'text/csv'):
+            content_type = 'application/json'
+        job = CensusJob(event=e, content_type=content_type)
+        job.validation = request.GET.get('field-validation', 'enabled') == 'enabled'
+        job.payload = request.body.decode('utf-8')
+        job.save()
+
+        census_import_task.apply_async(args=[job.pk])
+        jsondata = json.dumps({'status': 'ok', 'job': job.pk})
+        return HttpResponse(jsondata, status=202, content_type='application/json')
 census = login_required(Census.as_view())
 
 
+class CensusJobView(View):
+    ''' Get the progress of a census import job '''
+
+    def get(self, request, pk, job):
+        permission_required(request.user, 'AuthEvent', 'edit', pk)
+        job = get_object_or_404(CensusJob, pk=job, event_id=pk)
+        jsondata = json.dumps(job.serialize())
+        return HttpResponse(jsondata, content_type='application/json')
+census_job = login_required(CensusJobView.as_view())
+
+
+class CensusStream(View):
+    '''
+    Add census in the auth-event from a NDJSON or CSV body. The census is read
+    and imported in chunks, and the progress of each chunk is streamed back.
+    '''
+
+    def post(self, request, pk):
+        permission_required(request.user, 'AuthEvent', 'edit', pk)
+        e = get_object_or_404(AuthEvent, pk=pk)
+        content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+        if content_type == 'application/x-ndjson':
+            rows = ndjson_census(request)
+        elif content_type == 'text/csv':
+            rows = csv_census(e, request)
+        else:
+            bad_request = json.dumps({"error": "bad_request"})
+            return HttpResponseBadRequest(bad_request, content_type='application/json')
+
+        validation = request.GET.get('field-validation', 'enabled') == 'enabled'
+        progress = self.progress(auth_census_chunks(e, rows, validation))
+        return StreamingHttpResponse(progress, content_type='application/x-ndjson')
+
+    def progress(self, chunks):
+        data = {'status': 'ok', 'rows': 0, 'created': 0}
+        try:
+            for chunk in chunks:
+                data['rows'] += chunk['rows']
+                data['created'] += chunk['created']
+                yield json.dumps(chunk) + '\n'
+        except:
+            data['status'] = 'nok'
+            data['msg'] = 'Invalid census data after row %d' % data['rows']
+        yield json.dumps(data) + '\n'
+census_stream = login_required(CensusStream.as_view())
+
+
 class Authenticate(View):
     ''' Authenticate into the authapi '''
 
@@ -118,7 +316,7 @@ class Authenticate(View):
         if extend_auth:
             return extend_auth
         try:
-            data = auth_authenticate(e, request)
+            data = auth_authenticate(e, AuthContext(request))
         except:
             return HttpResponseBadRequest("", content_type='application/json')
 
@@ -162,7 +360,7 @@ class Register(View):
             })
             return HttpResponse(jsondata, status=400, content_type='application/json')
 
-        data = auth_register(e, request)
+        data = auth_register(e, AuthContext(request))
         status = 200 if data['status'] == 'ok' else 400
         jsondata = json.dumps(data)
         return HttpResponse(jsondata, status=status, content_type='application/json')
@@ -176,8 +374,8 @@ class AuthEventStatus(View):
         permission_required(request.user, 'AuthEvent', 'edit', pk)
         e = get_object_or_404(AuthEvent, pk=pk)
         if e.status != status:
-            e.status = status
-            e.save()
+            # updated, so a colorlist_version changed meanwhile isn't saved back
+            AuthEvent.objects.filter(pk=pk).update(status=status)
             st = 200
         else:
             st = 400
@@ -385,7 +583,13 @@ class AuthEventView(View):
                 ae.auth_method_config.get('config').update(config)
             if extra_fields:
                 ae.extra_fields = extra_fields
-            ae.save()
+            AuthEvent.objects.filter(pk=pk).update(auth_method=ae.auth_method,
+                                                   auth_method_config=ae.auth_method_config,
+                                                   extra_fields=ae.extra_fields)
+
+            if extra_fields:
+                from authmethods.utils import reindex_unique_values
+                reindex_unique_values(ae)
 
             # TODO: Problem if object_id is None, change None by 0
             acl = get_object_or_404(ACL, user=request.user.userdata,
@@ -560,6 +764,14 @@ user_auth_event = login_required(UserAuthEvent.as_view())
 
 
 class CensusSendAuth(View):
+    def get(self, request, pk):
+        ''' Progress of the last sendings of auth codes to the census '''
+        permission_required(request.user, 'AuthEvent', 'edit', pk)
+        e = get_object_or_404(AuthEvent, pk=pk)
+        jobs = e.send_auth_jobs.order_by('-id')[:settings.SEND_AUTH_JOBS_LIST]
+        jsondata = json.dumps({'jobs': [job.serialize() for job in jobs]})
+        return HttpResponse(jsondata, content_type='application/json')
+
     def post(self, request, pk):
         ''' Send authentication emails to the whole census '''
         permission_required(request.user, 'AuthEvent', 'edit', pk)
@@ -600,3 +812,28 @@ class CensusSendAuth(View):
         jsondata = json.dumps(data)
         return HttpResponse(jsondata, content_type='application/json')
 census_send_auth = login_required(CensusSendAuth.as_view())
+
+
+class CensusSendAuthResume(View):
+    def post(self, request, pk, job):
+        '''
+        Resume a sending of auth codes, sending them to the recipients still
+        queued, and also to the failed ones with retry-failed
+        '''
+        permission_required(request.user, 'AuthEvent', 'edit', pk)
+        e = get_object_or_404(AuthEvent, pk=pk)
+        if e.status != 'started':
+          jsondata = json.dumps({'error': 'AuthEvent with id = %s has not started' % pk})
+          return HttpResponseBadRequest(jsondata, content_type='application/json')
+        job = get_object_or_404(SendAuthJob, pk=job, event=e)
+
+        try:
+            req = json.loads(request.body.decode('utf-8') or '{}')
+        except:
+            bad_request = json.dumps({"error": "bad_request"})
+            return HttpResponseBadRequest(bad_request, content_type='application/json')
+
+        queued = resume_send_auth_job(job, bool(req.get('retry-failed', False)))
+        jsondata = json.dumps({'status': 'ok', 'queued': queued})
+        return HttpResponse(jsondata, content_type='application/json')
+census_send_auth_resume = login_required(CensusSendAuthResume.as_view())
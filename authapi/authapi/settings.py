@@ -125,6 +125,57 @@ SMS_URL = ""
 SMS_SENDER_ID = ""
 SMS_VOICE_LANG_CODE = ""
 
+# connections kept alive to the sms provider by each process, and the
+# connect and read timeouts of its requests, in seconds
+SMS_HTTP_POOL_SIZE = 10
+SMS_CONNECT_TIMEOUT = 5
+SMS_READ_TIMEOUT = 30
+
+# max number of messages sent in a request by the sms providers with batches
+SMS_BATCH_SIZE = 50
+
+# max number of requests to the sms provider in flight in each process
+SMS_CONCURRENCY = 8
+
+# messages per second and burst of the sends to each provider, by its
+# SMS_PROVIDER name or 'email', like {'altiria': {'rate': 20, 'burst': 50}}.
+# The sends to a provider without rate aren't paced
+SEND_RATES = {}
+
+# where the sends are paced: 'local' to pace each process on its own, or
+# 'cache' to pace all the workers sharing the SEND_RATE_CACHE django cache,
+# which can't be a cache of each process, like the locmem one
+SEND_RATE_BACKEND = 'local'
+SEND_RATE_CACHE = 'default'
+
+# max seconds a process keeps a color list without reading it again
+COLORLIST_INDEX_TTL = 300
+
+# max number of auth events whose color list is kept by a process
+COLORLIST_INDEXES = 1000
+
+# where the pipeline counters, like the messages sent to a tlf, are kept:
+# 'db' to count in the database, 'cache' to count in the COUNTER_CACHE
+# django cache, which must be shared by all the processes, like memcached,
+# or 'local' to count in each process. The counters with a period are
+# counted in COUNTER_BUCKETS time buckets, and the ones without period are
+# kept COUNTER_TTL seconds, then they are seeded again from the database
+COUNTER_BACKEND = 'db'
+COUNTER_CACHE = 'default'
+COUNTER_BUCKETS = 10
+COUNTER_TTL = 24 * 3600
+
+# number of tlf numbers kept in the canonical format cache
+TLF_CACHE_SIZE = 10000
+
+# number of distinct pipeline configs kept compiled
+PIPELINE_CACHE_SIZE = 1000
+
+# max number of audit rows (sent messages and connections) and max seconds
+# they wait before they are inserted
+AUDIT_BUFFER_SIZE = 500
+AUDIT_BUFFER_AGE = 5
+
 MAX_AUTH_MSG_SIZE = {
   "sms": 120,
   "email": 10000
@@ -137,6 +188,16 @@ EMAIL_BASE_TEMPLATE = "%s\n\n -- Agora Voting https://agoravoting.com"
 SMS_AUTH_CODE_URL = "https://agoravoting.example.com/#/election/%(authid)s/public/login"
 EMAIL_AUTH_CODE_URL = "https://agoravoting.example.com/#/election/%(authid)s/public/login/%(email)s/%(code)s"
 
+# number of census users whose codes are sent by each celery task
+SEND_CODES_CHUNK = 500
+
+# users of a chunk sent before saving their status in the outbox, so a
+# chunk run again after its worker died only sends its last batch again
+SEND_CODES_BATCH = 50
+
+# number of sendings listed in the census send_auth progress
+SEND_AUTH_JOBS_LIST = 10
+
 SEND_CODES_SMS_MAX = 3
 SEND_CODES_EMAIL_MAX = 3
 SIZE_CODE = 8
@@ -144,6 +205,22 @@ MAX_GLOBAL_STR = 512
 MAX_EXTRA_FIELDS = 15
 MAX_SIZE_NAME_EXTRA_FIELD = 1024
 
+# number of census rows created in each transaction by the census import
+CENSUS_IMPORT_CHUNK = 500
+
+# number of voters read in each query by the census export
+CENSUS_EXPORT_CHUNK = 1000
+
+# seconds before the request of the census sync cursor, so the voters saved
+# by transactions that commit after the request are returned by the next sync
+CENSUS_CURSOR_MARGIN = 60
+
+# number of processes hashing the census passwords, None to use one per core
+CENSUS_HASH_PROCESSES = None
+
+# number of chunk errors kept in a census import job
+CENSUS_JOB_MAX_ERRORS = 20
+
 # Auth api settings
 from auth_settings import *
 
@@ -9,18 +9,23 @@ def check_config(config, auth_method):
     return METHODS[auth_method].check_config(config)
 
 
-def auth_census(event, data):
-    return METHODS[event.auth_method].census(event, data)
+def auth_census(event, ctx):
+    return METHODS[event.auth_method].census(event, ctx)
 
 
-def auth_register(event, data):
-    return METHODS[event.auth_method].register(event, data)
+def auth_census_chunks(event, census, validation=True):
+    from authmethods.census import census_import_chunks
+    return census_import_chunks(METHODS[event.auth_method], event, census, validation)
 
 
-def auth_authenticate(event, data):
+def auth_register(event, ctx):
+    return METHODS[event.auth_method].register(event, ctx)
+
+
+def auth_authenticate(event, ctx):
     if event == 0:
-        return METHODS['user-and-password'].authenticate(event, data)
-    return METHODS[event.auth_method].authenticate(event, data)
+        return METHODS['user-and-password'].authenticate(event, ctx)
+    return METHODS[event.auth_method].authenticate(event, ctx)
 
 
 def register_method(name, klass):
@@ -0,0 +1,56 @@
+import threading
+import time
+from celery.signals import task_postrun
+from django.conf import settings
+from django.core.signals import request_finished
+from django.dispatch import receiver
+
+
+class AuditBuffer(object):
+    '''
+    Write-behind buffer of audit rows, like the Message and Connection ones.
+    The rows are collected and inserted with one bulk_create per model when
+    settings.AUDIT_BUFFER_SIZE rows are waiting, or when the oldest one has
+    waited settings.AUDIT_BUFFER_AGE seconds. The buffer is flushed at the
+    end of each celery task and request, so no row is lost.
+
+    The created date of the rows is the date of the insert, so it can be
+    AUDIT_BUFFER_AGE seconds later than the event it records.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.count = 0
+        self.since = None
+
+    def add(self, obj):
+        ''' Adds a row to the buffer, flushing it if it's full or old '''
+        with self.lock:
+            self.rows.setdefault(type(obj), []).append(obj)
+            self.count += 1
+            if self.since is None:
+                self.since = time.time()
+            due = (self.count >= settings.AUDIT_BUFFER_SIZE or
+                   time.time() - self.since >= settings.AUDIT_BUFFER_AGE)
+        if due:
+            self.flush()
+
+    def flush(self):
+        ''' Inserts the rows in the buffer '''
+        with self.lock:
+            rows = self.rows
+            self.rows = {}
+            self.count = 0
+            self.since = None
+        for model, objs in rows.items():
+            model.objects.bulk_create(objs)
+
+
+audit_buffer = AuditBuffer()
+
+
+@receiver(request_finished)
+@task_postrun.connect
+def flush_audit_buffer(*args, **kwargs):
+    audit_buffer.flush()
@@ -0,0 +1,281 @@
+import csv
+import json
+import multiprocessing
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+
+from api.models import ACL, UniqueValue, UserData
+from .utils import (
+    get_cannonical_tlf,
+    insert_with_usernames,
+    perms_acls,
+    set_user_fields,
+    unique_fields,
+    unique_value,
+    unique_values,
+)
+
+
+class CensusIndex(object):
+    '''
+    Emails, tlfs and unique extra field values already used in an auth event.
+    They are loaded once, so each census row is checked against in-memory
+    sets instead of querying every user of the event.
+    '''
+
+    def __init__(self, ae):
+        self.uniques = unique_fields(ae)
+        self.emails = set()
+        self.tlfs = set()
+        self.values = dict((name, set()) for name in self.uniques)
+
+        userdata = UserData.objects.filter(event=ae)
+        for email, tlf in userdata.values_list('user__email', 'tlf').iterator():
+            self.emails.add(email)
+            self.tlfs.add(tlf)
+        if self.uniques:
+            values = UniqueValue.objects.filter(event=ae, name__in=self.uniques)
+            for name, value in values.values_list('name', 'value').iterator():
+                self.values[name].add(value)
+
+    def repeated(self, req):
+        '''
+        Returns the same message that exist_user would return for req, or ''
+        if req doesn't repeat any user of the event.
+        '''
+        msg = ''
+        if req.get('email') and req.get('email') in self.emails:
+            msg += "Email %s repeat." % req.get('email')
+        if req.get('tlf') and get_cannonical_tlf(req['tlf']) in self.tlfs:
+            msg += "Tel %s repeat." % req.get('tlf')
+        if msg:
+            return msg
+
+        for name in self.uniques:
+            value = req.get(name)
+            if value is not None and unique_value(value) in self.values[name]:
+                return "%s %s repeat." % (name, value)
+        return ''
+
+    def add(self, req):
+        ''' Adds the values of a new user, given its request, to the index '''
+        if req.get('email'):
+            self.emails.add(req.get('email'))
+        if req.get('tlf'):
+            self.tlfs.add(get_cannonical_tlf(req['tlf']))
+        for name in self.uniques:
+            if req.get(name) is not None:
+                self.values[name].add(unique_value(req.get(name)))
+
+
+def check_census(method, ae, census, index, validation=True):
+    '''
+    Checks the census rows against the index, returning the errors and the
+    rows to create.
+
+    The method can prepare the rows with prepare_census, and then it checks
+    the fields of each row with check_census_row, which returns the key of
+    the row used to find repeated rows inside the census and the error
+    message. With validation enabled, any error rejects the
+    whole census; with validation disabled, the wrong and repeated rows are
+    skipped. The rows to create are added to the index.
+    '''
+    msg = ''
+    current = set()
+    rows = []
+    if hasattr(method, 'prepare_census'):
+        method.prepare_census(census)
+    for r in census:
+        key, row_msg = method.check_census_row(ae, r, validation)
+        if validation:
+            msg += row_msg + index.repeated(r)
+            if key in current:
+                msg += method.CENSUS_REPEAT_MSG % key
+            current.add(key)
+            rows.append(r)
+        elif not row_msg and not index.repeated(r):
+            index.add(r)
+            rows.append(r)
+
+    if msg and validation:
+        return msg, []
+    if validation:
+        for r in rows:
+            index.add(r)
+    return '', rows
+
+
+def census_import(method, ae, census, validation=True):
+    ''' Imports a census in the auth event '''
+    msg, rows = check_census(method, ae, census, CensusIndex(ae), validation)
+    if msg:
+        return {'status': 'nok', 'msg': msg}
+
+    hasher = PasswordHasher()
+    try:
+        create_census_users(ae, rows, hasher)
+    finally:
+        hasher.close()
+    return {'status': 'ok'}
+
+
+def census_import_chunks(method, ae, census, validation=True):
+    '''
+    Imports a census given as an iterable of rows, reading and committing
+    settings.CENSUS_IMPORT_CHUNK rows at a time, so only one chunk is kept in
+    memory. Yields the progress of each chunk. With validation enabled, a
+    chunk with errors is rejected, but the other chunks are still imported.
+    '''
+    index = CensusIndex(ae)
+    hasher = PasswordHasher()
+    try:
+        for n, chunk in enumerate(chunks(census, settings.CENSUS_IMPORT_CHUNK)):
+            msg, rows = check_census(method, ae, chunk, index, validation)
+            create_census_users(ae, rows, hasher)
+            data = {
+                'status': 'nok' if msg else 'ok',
+                'chunk': n,
+                'rows': len(chunk),
+                'created': len(rows),
+            }
+            if msg:
+                data['msg'] = msg
+            yield data
+    finally:
+        hasher.close()
+
+
+def chunks(iterable, size):
+    ''' Splits an iterable in lists of size elements '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ndjson_census(lines):
+    ''' Reads the census rows from NDJSON lines, one json object per line '''
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if line.strip():
+            yield json.loads(line)
+
+
+def csv_census(ae, lines):
+    '''
+    Reads the census rows from CSV lines, being the first one the header
+    with the field names. Empty values are skipped, and the values of int
+    and bool extra fields are converted to their type.
+    '''
+    types = dict((extra.get('name'), extra.get('type')) for extra in ae.extra_fields or [])
+    lines = (l.decode('utf-8') if isinstance(l, bytes) else l for l in lines)
+    for row in csv.DictReader(lines):
+        r = {}
+        for name, value in row.items():
+            if name is None or value is None or value == '':
+                continue
+            if types.get(name) == 'int':
+                value = int(value)
+            elif types.get(name) == 'bool':
+                value = value.lower() in ('true', '1', 'yes')
+            r[name] = value
+        yield r
+
+
+def create_census_users(ae, census, hasher):
+    '''
+    Creates the users of the census rows, already validated, with their
+    userdata and perms, hashing their passwords with hasher. Each chunk of
+    settings.CENSUS_IMPORT_CHUNK rows is created in its own transaction with
+    a fixed number of queries.
+    '''
+    size = settings.CENSUS_IMPORT_CHUNK
+    for i in range(0, len(census), size):
+        users, userdatas = _census_users(ae, census[i:i + size], hasher)
+        insert_with_usernames(users, lambda: _insert_users(ae, users, userdatas))
+
+
+class PasswordHasher(object):
+    '''
+    Hashes the passwords of a census import with make_password, like
+    set_password does, in a pool of settings.CENSUS_HASH_PROCESSES
+    processes, or one per core if it's None, created the first time it's
+    needed and kept for the whole import. A celery worker is a daemon
+    process that can't have children, so there, like with only one process,
+    they are hashed in this process: the import task already runs out of
+    the request.
+    '''
+
+    def __init__(self):
+        self.pool = None
+
+    def __call__(self, passwords):
+        processes = settings.CENSUS_HASH_PROCESSES or multiprocessing.cpu_count()
+        if (processes < 2 or len(passwords) < 2 or
+                multiprocessing.current_process().daemon):
+            return [make_password(p) for p in passwords]
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(processes)
+        return self.pool.map(make_password, passwords)
+
+    def close(self):
+        ''' Stops the pool, if it was created '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def _census_users(ae, census, hasher):
+    users = []
+    userdatas = []
+    for r in census:
+        u = User()
+        u.is_active = r.get('status', 'registered') == 'used'
+        ud = UserData(event=ae)
+        set_user_fields(u, ud, r, ae, hash_password=False)
+        users.append(u)
+        userdatas.append(ud)
+
+    if any(extra.get('type') == 'password' for extra in ae.extra_fields or []):
+        passwords = hasher([u.password for u in users])
+        for u, password in zip(users, passwords):
+            u.password = password
+    return users, userdatas
+
+
+def _insert_users(ae, users, userdatas):
+    # bulk_create doesn't set the ids, so they are queried back by username
+    User.objects.bulk_create(users)
+    ids = dict(User.objects.filter(username__in=[u.username for u in users])
+                           .values_list('username', 'id'))
+    for u, ud in zip(users, userdatas):
+        u.pk = ids[u.username]
+        ud.user_id = u.pk
+    UserData.objects.bulk_create(userdatas)
+
+    uniques = unique_fields(ae)
+    inactive = [u for u in users if not u.is_active]
+    if not inactive and not uniques:
+        return
+    udids = dict(UserData.objects.filter(user_id__in=list(ids.values()))
+                                 .values_list('user_id', 'id'))
+    for u, ud in zip(users, userdatas):
+        ud.pk = udids[u.pk]
+
+    # Active users don't give perms, like in give_perms
+    acls = []
+    values = []
+    for u, ud in zip(users, userdatas):
+        if not u.is_active:
+            acls.extend(perms_acls(u, ud, ae))
+        if uniques:
+            values.extend(unique_values(ud, json.loads(ud.metadata), ae))
+    ACL.objects.bulk_create(acls)
+    UniqueValue.objects.bulk_create(values)
@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from api.models import AuthEvent
+from .models import ColorList
+
+
+class ColorListIndex(object):
+    '''
+    Values of the color list of an auth event, in a set for each key and
+    action, so the white and black list checks don't query the table.
+    '''
+
+    def __init__(self, auth_event_id, version):
+        self.version = version
+        self.loaded = time.time()
+        self.values = {}
+        items = ColorList.objects.filter(auth_event_id=auth_event_id)
+        for key, action, value in items.values_list('key', 'action', 'value').iterator():
+            self.values.setdefault((key, action), set()).add(value)
+
+    def contains(self, key, action, value):
+        ''' Returns if the value is in the list of the key and action '''
+        return value in self.values.get((key, action), ())
+
+
+# color list indexes of this process, by auth event id, the oldest loaded
+# first, up to settings.COLORLIST_INDEXES
+_indexes = OrderedDict()
+
+def colorlist_index(ae):
+    '''
+    Returns the color list index of an auth event. It's loaded once, and
+    loaded again when the colorlist_version of the auth event changes, or
+    after settings.COLORLIST_INDEX_TTL seconds, for the changes made without
+    saving the models, like bulk updates.
+    '''
+    index = _indexes.get(ae.pk)
+    if (index is None or index.version != ae.colorlist_version or
+            time.time() - index.loaded > settings.COLORLIST_INDEX_TTL):
+        index = ColorListIndex(ae.pk, ae.colorlist_version)
+        _indexes.pop(ae.pk, None)
+        _indexes[ae.pk] = index
+        if len(_indexes) > settings.COLORLIST_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+@receiver(post_save, sender=ColorList)
+@receiver(post_delete, sender=ColorList)
+def colorlist_changed(sender, instance, **kwargs):
+    '''
+    Increments the colorlist_version of the auth event, so all the processes
+    load its color list again
+    '''
+    AuthEvent.objects.filter(pk=instance.auth_event_id).update(
+        colorlist_version=F('colorlist_version') + 1)
+
+
+@receiver(post_save, sender=AuthEvent)
+def new_colorlist(sender, instance, created, **kwargs):
+    # a new auth event can take the id of a deleted one
+    if created:
+        _indexes.pop(instance.pk, None)
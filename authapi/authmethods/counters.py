@@ -0,0 +1,278 @@
+import hashlib
+import math
+import random
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from api.models import AuthEvent
+from .models import Counter
+from .registry import Registry
+
+
+class LocalCounterBackend(object):
+    '''
+    Keeps the counters in the memory of this process, so each process
+    counts on its own. The expired counters are purged every PURGE_EVERY
+    updates.
+    '''
+
+    PURGE_EVERY = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.updates = 0
+
+    def _get(self, key, now):
+        value = self.values.get(key)
+        if value is None or (value[1] is not None and value[1] <= now):
+            return None
+        return value[0]
+
+    def _expires(self, timeout, now):
+        return None if timeout is None else now + timeout
+
+    def set(self, key, value, timeout=None):
+        ''' Sets the key '''
+        with self.lock:
+            self.values[key] = (value, self._expires(timeout, time.time()))
+
+    def add(self, key, value, timeout=None):
+        ''' Sets the key if it's not set, returning if it was set '''
+        with self.lock:
+            now = time.time()
+            if self._get(key, now) is not None:
+                return False
+            self.values[key] = (value, self._expires(timeout, now))
+            return True
+
+    def incr(self, key, delta=1, timeout=None):
+        ''' Adds delta to the key, starting at 0, returning the new value '''
+        with self.lock:
+            now = time.time()
+            if self._get(key, now) is None:
+                self.values[key] = (delta, self._expires(timeout, now))
+            else:
+                value, expires = self.values[key]
+                self.values[key] = (value + delta, expires)
+            self.updates += 1
+            if self.updates % self.PURGE_EVERY == 0:
+                self.values = dict((k, v) for k, v in self.values.items()
+                                   if v[1] is None or v[1] > now)
+            return self.values[key][0]
+
+    def get_many(self, keys):
+        ''' Returns the values of the keys that are set '''
+        with self.lock:
+            now = time.time()
+            values = ((key, self._get(key, now)) for key in keys)
+            return dict((key, value) for key, value in values if value is not None)
+
+
+class DatabaseCounterBackend(object):
+    '''
+    Keeps the counters in the Counter table, so all the workers sharing the
+    database count together, without a shared cache. The counters are
+    updated with an atomic UPDATE, and the expired ones are deleted every
+    PURGE_EVERY updates of each process.
+    '''
+
+    PURGE_EVERY = 10000
+
+    def __init__(self):
+        self.updates = 0
+
+    def _key(self, key):
+        # the keys have tlfs and emails, the longer ones are hashed to fit
+        if len(key) > 255:
+            return hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return key
+
+    def _expires(self, timeout):
+        return None if timeout is None else timezone.now() + timedelta(seconds=timeout)
+
+    def _live(self):
+        return Q(expires__isnull=True) | Q(expires__gt=timezone.now())
+
+    def set(self, key, value, timeout=None):
+        ''' Same as LocalCounterBackend.set '''
+        counters = Counter.objects.filter(key=self._key(key))
+        if not counters.update(value=value, expires=self._expires(timeout)):
+            if not self.add(key, value, timeout):
+                counters.update(value=value, expires=self._expires(timeout))
+
+    def add(self, key, value, timeout=None):
+        ''' Same as LocalCounterBackend.add '''
+        key = self._key(key)
+        # an expired counter is taken as not set
+        expired = Counter.objects.filter(key=key, expires__lte=timezone.now())
+        if expired.update(value=value, expires=self._expires(timeout)):
+            return True
+        try:
+            with transaction.atomic():
+                Counter.objects.create(key=key, value=value, expires=self._expires(timeout))
+            return True
+        except IntegrityError:
+            return False
+
+    def incr(self, key, delta=1, timeout=None):
+        ''' Same as LocalCounterBackend.incr '''
+        self.updates += 1
+        if self.updates % self.PURGE_EVERY == 0:
+            Counter.objects.filter(expires__lte=timezone.now()).delete()
+
+        counters = Counter.objects.filter(key=self._key(key))
+        while True:
+            if counters.filter(self._live()).update(value=F('value') + delta):
+                return counters.values_list('value', flat=True)[0]
+            if self.add(key, delta, timeout):
+                return delta
+
+    def get_many(self, keys):
+        ''' Same as LocalCounterBackend.get_many '''
+        keys = dict((self._key(key), key) for key in keys)
+        counters = Counter.objects.filter(self._live(), key__in=list(keys))
+        return dict((keys[key], value) for key, value in counters.values_list('key', 'value'))
+
+
+class CacheCounterBackend(object):
+    '''
+    Keeps the counters in the django cache settings.COUNTER_CACHE, so all the
+    workers sharing the cache count together. The counters are updated with
+    the atomic cache.add and cache.incr. A cache local to each process, like
+    the default one without CACHES, would count each process on its own, so
+    it isn't allowed.
+    '''
+
+    def __init__(self):
+        self.cache = caches[settings.COUNTER_CACHE]
+        if isinstance(self.cache, (LocMemCache, DummyCache)):
+            raise ImproperlyConfigured(
+                "COUNTER_CACHE='%s' isn't shared by the processes, use "
+                "COUNTER_BACKEND='db' or a shared cache" % settings.COUNTER_CACHE)
+
+    def set(self, key, value, timeout=None):
+        ''' Same as LocalCounterBackend.set '''
+        self.cache.set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        ''' Same as LocalCounterBackend.add '''
+        return self.cache.add(key, value, timeout)
+
+    def incr(self, key, delta=1, timeout=None):
+        ''' Same as LocalCounterBackend.incr '''
+        try:
+            return self.cache.incr(key, delta)
+        except ValueError:
+            if self.cache.add(key, delta, timeout):
+                return delta
+            return self.cache.incr(key, delta)
+
+    def get_many(self, keys):
+        ''' Same as LocalCounterBackend.get_many '''
+        return self.cache.get_many(keys)
+
+
+# counter backend classes by name, and the instance of the configured one
+COUNTER_BACKENDS = Registry('COUNTER_BACKEND')
+
+def register_counter_backend(name, klass):
+    ''' Registers a counter backend, to be used with COUNTER_BACKEND = name '''
+    COUNTER_BACKENDS.register(name, klass)
+
+
+def counter_backend():
+    ''' Returns the counter backend of the app config, shared by the threads '''
+    return COUNTER_BACKENDS.instance()
+
+
+def generation_key(auth_event_id):
+    return 'counters-generation:%s' % auth_event_id
+
+
+def event_counters(auth_event_id):
+    '''
+    Returns the prefix of the counter keys of an auth event. It has the
+    generation of the auth event, set when it's created, so a new auth event
+    that takes the id of a deleted one doesn't take its counters.
+    '''
+    backend = counter_backend()
+    key = generation_key(auth_event_id)
+    generation = backend.get_many([key]).get(key)
+    if generation is None:
+        backend.add(key, random.getrandbits(31))
+        generation = backend.get_many([key]).get(key)
+    return 'counters:%s:%s' % (auth_event_id, generation)
+
+
+@receiver(post_save, sender=AuthEvent)
+def new_generation(sender, instance, created, **kwargs):
+    ''' Sets the generation of the counters of a new auth event '''
+    if created:
+        counter_backend().set(generation_key(instance.pk), random.getrandbits(31))
+
+
+class WindowCounter(object):
+    '''
+    Counts the hits of a key in a sliding window of period seconds, split in
+    settings.COUNTER_BUCKETS time buckets, so a hit is an increment of the
+    current bucket and a read of the others, whatever the number of hits.
+    Without period, the hits are counted for settings.COUNTER_TTL seconds.
+    '''
+
+    def __init__(self, key, period=None):
+        self.key = key
+        self.period = period
+
+    def buckets(self):
+        ''' Returns the keys of the buckets of the window, the current first '''
+        if not self.period:
+            return ['%s:0' % self.key]
+        width = self.period / settings.COUNTER_BUCKETS
+        current = int(time.time() // width)
+        return ['%s:%d' % (self.key, b)
+                for b in range(current, current - settings.COUNTER_BUCKETS, -1)]
+
+    def timeout(self):
+        ''' Seconds a bucket is kept, until it leaves the window '''
+        if not self.period:
+            return settings.COUNTER_TTL
+        return int(math.ceil(self.period + self.period / settings.COUNTER_BUCKETS))
+
+    def count(self):
+        ''' Returns the number of hits in the window '''
+        return sum(counter_backend().get_many(self.buckets()).values())
+
+    def hit(self, seed=None):
+        '''
+        Adds a hit, returning the number of hits in the window before it.
+        When the window is empty, seed is called to get the hits it already
+        had, like the rows of a table in the period. The seeded flag, kept
+        for a bucket, makes the concurrent first hits seed it once.
+        '''
+        backend = counter_backend()
+        buckets = self.buckets()
+        timeout = self.timeout()
+        values = backend.get_many(buckets)
+        hits = 1
+        seeded = self.period / settings.COUNTER_BUCKETS if self.period else timeout
+        if seed is not None and not values and backend.add('%s:seeded' % self.key, 1, seeded):
+            hits += seed()
+        count = backend.incr(buckets[0], hits, timeout)
+        return count - 1 + sum(v for k, v in values.items() if k != buckets[0])
+
+
+register_counter_backend('local', LocalCounterBackend)
+register_counter_backend('db', DatabaseCounterBackend)
+register_counter_backend('cache', CacheCounterBackend)
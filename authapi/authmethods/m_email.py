@@ -1,4 +1,3 @@
-import json
 from django.conf import settings
 from django.conf.urls import patterns, url
 from django.contrib.auth.models import User
@@ -6,6 +5,7 @@ from utils import genhmac, constant_time_compare, send_codes
 
 from . import register_method
 from authmethods.utils import *
+from authmethods.census import census_import
 from api.models import AuthEvent
 from authmethods.models import Code
 
@@ -27,10 +27,11 @@ class Email:
             ["check_total_max", {"field": "ip", "max": 8}],
         ],
         "authenticate-pipeline": [
-            #['check_total_connection', {'times': 5 }],
+            ['check_total_connection', {'times': 10, 'period': 3600}],
         ]
     }
     USED_TYPE_FIELDS = ['email']
+    CENSUS_REPEAT_MSG = "Email %s repeat in this census."
 
     email_definition = { "name": "email", "type": "email", "required": True, "min": 4, "max": 255, "required_on_authentication": True }
     code_definition = { "name": "code", "type": "text", "required": True, "min": 6, "max": 255, "required_on_authentication": True }
@@ -43,51 +44,27 @@ class Email:
                 msg += "Invalid config: %s not possible.\n" % c
         return msg
 
-    def census(self, ae, request):
-        req = json.loads(request.body.decode('utf-8'))
-        validation = req.get('field-validation', 'enabled') == 'enabled'
-
+    def check_census_row(self, ae, r, validation=True):
+        """ Check the fields of a census row, returns its email and the errors. """
         msg = ''
-        current_emails = []
-        for r in req.get('census'):
-            email = r.get('email')
-            if isinstance(email, str):
-                email = email.strip()
-            msg += check_field_type(self.email_definition, email)
-            if validation:
-                msg += check_field_type(self.email_definition, email)
-                msg += check_field_value(self.email_definition, email)
-            msg += check_fields_in_request(r, ae, 'census', validation=validation)
-            if validation:
-                msg += exist_user(r, ae)
-                if email in current_emails:
-                    msg += "Email %s repeat in this census." % email
-                current_emails.append(email)
-            else:
-                if msg:
-                    msg = ''
-                    continue
-                exist = exist_user(r, ae)
-                if exist and not exist.count('None'):
-                    continue
-                used = r.get('status', 'registered') == 'used'
-                u = create_user(r, ae, used)
-                give_perms(u, ae)
-        if msg and validation:
-            data = {'status': 'nok', 'msg': msg}
-            return data
-
+        email = r.get('email')
+        if isinstance(email, str):
+            email = email.strip()
+        msg += check_field_type(self.email_definition, email)
         if validation:
-            for r in req.get('census'):
-                used = r.get('status', 'registered') == 'used'
-                u = create_user(r, ae, used)
-                give_perms(u, ae)
-        return {'status': 'ok'}
+            msg += check_field_value(self.email_definition, email)
+        msg += check_fields_in_request(r, ae, 'census', validation=validation)
+        return email, msg
+
+    def census(self, ae, ctx):
+        req = ctx.req
+        validation = req.get('field-validation', 'enabled') == 'enabled'
+        return census_import(self, ae, req.get('census'), validation)
 
-    def register(self, ae, request):
-        req = json.loads(request.body.decode('utf-8'))
+    def register(self, ae, ctx):
+        req = ctx.req
 
-        msg = check_pipeline(request, ae)
+        msg = check_pipeline(ctx, ae)
         if msg:
             return msg
 
@@ -126,8 +103,8 @@ class Email:
         d = {'status': 'nok'}
         return d
 
-    def authenticate(self, ae, request):
-        req = json.loads(request.body.decode('utf-8'))
+    def authenticate(self, ae, ctx):
+        req = ctx.req
         msg = ''
         email = req.get('email')
         if isinstance(email, str):
@@ -141,22 +118,25 @@ class Email:
             data = {'status': 'nok', 'msg': msg}
             return data
 
-        msg = check_pipeline(request, ae, 'authenticate')
+        msg = check_pipeline(ctx, ae, 'authenticate')
         if msg:
             return msg
 
         try:
             u = User.objects.get(email=email, userdata__event=ae)
         except:
+            failed_connection(ctx, ae)
             return {'status': 'nok', 'msg': 'User not exist.'}
 
         code = Code.objects.filter(user=u.userdata,
                 code=req.get('code')).order_by('created').first()
         if not code:
+            failed_connection(ctx, ae)
             return {'status': 'nok', 'msg': 'Invalid code.'}
 
         msg = check_metadata(req, u)
         if msg:
+            failed_connection(ctx, ae)
             data = {'status': 'nok', 'msg': msg}
             return data
         u.is_active = True
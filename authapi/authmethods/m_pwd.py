@@ -26,9 +26,9 @@ class PWD:
         d = {'status': 'nok'}
         return d
 
-    def authenticate(self, ae, request):
+    def authenticate(self, ae, ctx):
         d = {'status': 'ok'}
-        req = json.loads(request.body.decode('utf-8'))
+        req = ctx.req
         msg = req.get('username', '')
         if not msg:
             msg = req.get('email', '')
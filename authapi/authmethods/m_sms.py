@@ -1,4 +1,3 @@
-import json
 from django.conf import settings
 from django.conf.urls import patterns, url
 from django.contrib.auth.models import User
@@ -8,6 +7,7 @@ from utils import genhmac, send_codes
 import plugins
 from . import register_method
 from authmethods.utils import *
+from authmethods.census import census_import
 
 
 class Sms:
@@ -30,11 +30,12 @@ class Sms:
             ["check_total_max", {"field": "tlf", "period": 1440, "max": 5}],
         ],
         "authenticate-pipeline": [
-            #['check_total_connection', {'times': 5 }],
+            ['check_total_connection', {'times': 10, 'period': 3600}],
             #['check_sms_code', {'timestamp': 5 }]
         ]
     }
     USED_TYPE_FIELDS = ['tlf']
+    CENSUS_REPEAT_MSG = "Tlf %s repeat."
 
     tlf_definition = { "name": "tlf", "type": "text", "required": True, "min": 4, "max": 20, "required_on_authentication": True }
     code_definition = { "name": "code", "type": "text", "required": True, "min": 6, "max": 255, "required_on_authentication": True }
@@ -47,58 +48,42 @@ class Sms:
                 msg += "Invalid config: %s not possible.\n" % c
         return msg
 
-    def census(self, ae, request):
-        req = json.loads(request.body.decode('utf-8'))
-        validation = req.get('field-validation', 'enabled') == 'enabled'
-        data = {'status': 'ok'}
-
-        msg = ''
-        current_tlfs = []
-        for r in req.get('census'):
+    def prepare_census(self, census):
+        """ Converts the tlf column of the census rows to the canonical format. """
+        tlfs = get_cannonical_tlfs([r.get('tlf') for r in census])
+        for r, tlf in zip(census, tlfs):
             if r.get('tlf'):
-                r['tlf'] = get_cannonical_tlf(r.get('tlf'))
-            tlf = r.get('tlf')
-            if isinstance(tlf, str):
-                tlf = tlf.strip()
-            msg += check_field_type(self.tlf_definition, tlf)
-            if validation:
-                msg += check_field_value(self.tlf_definition, tlf)
-            msg += check_fields_in_request(r, ae, 'census', validation=validation)
-            if validation:
-                msg += exist_user(r, ae)
-                if tlf in current_tlfs:
-                    msg += "Tlf %s repeat." % tlf
-                current_tlfs.append(tlf)
-            else:
-                if msg:
-                    msg = ''
-                    continue
-                exist = exist_user(r, ae)
-                if exist and not exist.count('None'):
-                    continue
-                used = r.get('status', 'registered') == 'used'
-                u = create_user(r, ae, used)
-                give_perms(u, ae)
-        if msg and validation:
-            data = {'status': 'nok', 'msg': msg}
-            return data
+                r['tlf'] = tlf
 
+    def check_census_row(self, ae, r, validation=True):
+        """
+        Check the fields of a census row, already prepared, returns its tlf
+        and the errors.
+        """
+        msg = ''
+        tlf = r.get('tlf')
+        if isinstance(tlf, str):
+            tlf = tlf.strip()
+        msg += check_field_type(self.tlf_definition, tlf)
         if validation:
-            for r in req.get('census'):
-                used = r.get('status', 'registered') == 'used'
-                u = create_user(r, ae, used)
-                give_perms(u, ae)
-        return data
+            msg += check_field_value(self.tlf_definition, tlf)
+        msg += check_fields_in_request(r, ae, 'census', validation=validation)
+        return tlf, msg
+
+    def census(self, ae, ctx):
+        req = ctx.req
+        validation = req.get('field-validation', 'enabled') == 'enabled'
+        return census_import(self, ae, req.get('census'), validation)
 
-    def register(self, ae, request):
-        req = json.loads(request.body.decode('utf-8'))
-        msg = check_pipeline(request, ae)
+    def register(self, ae, ctx):
+        req = ctx.req
+        msg = check_pipeline(ctx, ae)
         if msg:
             return msg
 
         msg = ''
         if req.get('tlf'):
-            req['tlf'] = get_cannonical_tlf(req.get('tlf'))
+            req['tlf'] = ctx.tlf
         tlf = req.get('tlf')
         if isinstance(tlf, str):
             tlf = tlf.strip()
@@ -134,12 +119,12 @@ class Sms:
         d = {'status': 'nok'}
         return d
 
-    def authenticate(self, ae, request):
-        req = json.loads(request.body.decode('utf-8'))
+    def authenticate(self, ae, ctx):
+        req = ctx.req
 
         msg = ''
         if req.get('tlf'):
-            req['tlf'] = get_cannonical_tlf(req.get('tlf'))
+            req['tlf'] = ctx.tlf
         tlf = req.get('tlf')
         if isinstance(tlf, str):
             tlf = tlf.strip()
@@ -152,22 +137,25 @@ class Sms:
             data = {'status': 'nok', 'msg': msg}
             return data
 
+        msg = check_pipeline(ctx, ae, 'authenticate')
+        if msg:
+            return msg
+
         try:
             u = User.objects.get(userdata__tlf=tlf, userdata__event=ae)
         except:
+            failed_connection(ctx, ae)
             return {'status': 'nok', 'msg': 'User not exist.'}
 
         code = Code.objects.filter(user=u.userdata,
                 code=req.get('code')).order_by('created').first()
         if not code:
+            failed_connection(ctx, ae)
             return {'status': 'nok', 'msg': 'Invalid code.'}
 
-        msg = check_pipeline(request, ae, 'authenticate')
-        if msg:
-            return msg
-
         msg = check_metadata(req, u)
         if msg:
+            failed_connection(ctx, ae)
             data = {'status': 'nok', 'msg': msg}
             return data
 
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authmethods', '0006_auto_20150215_2313'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='colorlist',
+            index_together=set([('auth_event_id', 'key', 'value')]),
+        ),
+    ]
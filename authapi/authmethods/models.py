@@ -18,6 +18,9 @@ class ColorList(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     auth_event_id = models.IntegerField()
 
+    class Meta:
+        index_together = [['auth_event_id', 'key', 'value']]
+
 class Message(models.Model):
     ip = models.CharField(max_length=15)
     tlf = models.CharField(max_length=20)
@@ -34,4 +37,13 @@ class Code(models.Model):
     user = models.ForeignKey(UserData, related_name="codes")
     code = models.CharField(max_length=64)
     created = models.DateTimeField(auto_now_add=True)
-    auth_event_id = models.IntegerField()
\ No newline at end of file
+    auth_event_id = models.IntegerField()
+
+class Counter(models.Model):
+    '''
+    Counter of the pipeline checks, see authmethods.counters. The counters
+    with expires are taken as not set after it.
+    '''
+    key = models.CharField(max_length=255, unique=True)
+    value = models.IntegerField()
+    expires = models.DateTimeField(null=True, db_index=True)
@@ -0,0 +1,124 @@
+import math
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+from .registry import Registry
+
+
+class LocalRateBackend(object):
+    '''
+    Keeps the rate limiters in the memory of this process, so each process
+    is paced on its own. The time is read from clock.
+    '''
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tats = {}
+
+    def reserve(self, key, cost, burst):
+        '''
+        Reserves cost seconds of the limiter, returning the seconds to wait
+        before using them. The limiter keeps the time when all the reserved
+        seconds are used, and up to burst seconds can be used in advance.
+        '''
+        with self.lock:
+            now = self.clock()
+            tat = max(self.tats.get(key, 0), now) + cost
+            self.tats[key] = tat
+        return max(0, tat - now - burst)
+
+
+class CacheRateBackend(object):
+    '''
+    Keeps the rate limiters in the django cache settings.SEND_RATE_CACHE, so
+    all the workers sharing the cache are paced together. A cache of each
+    process isn't accepted. The cache hasn't
+    got an atomic update, so each reserve holds a lock made with cache.add.
+    '''
+
+    LOCK_TIMEOUT = 5
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.cache = caches[settings.SEND_RATE_CACHE]
+        if isinstance(self.cache, (LocMemCache, DummyCache)):
+            raise ImproperlyConfigured(
+                "SEND_RATE_CACHE='%s' isn't shared by the processes, use "
+                "SEND_RATE_BACKEND='local' or a shared cache" % settings.SEND_RATE_CACHE)
+
+    def reserve(self, key, cost, burst):
+        ''' Same as LocalRateBackend.reserve '''
+        lock = key + ':lock'
+        while not self.cache.add(lock, 1, self.LOCK_TIMEOUT):
+            time.sleep(0.001)
+        try:
+            now = self.clock()
+            tat = max(self.cache.get(key, 0), now) + cost
+            self.cache.set(key, tat, math.ceil(tat - now) + 1)
+        finally:
+            self.cache.delete(lock)
+        return max(0, tat - now - burst)
+
+
+# rate backend classes by name, and the instance of the configured one
+RATE_BACKENDS = Registry('SEND_RATE_BACKEND')
+
+def register_rate_backend(name, klass):
+    ''' Registers a rate backend, to be used with SEND_RATE_BACKEND = name '''
+    RATE_BACKENDS.register(name, klass)
+
+
+def rate_backend():
+    ''' Returns the rate backend of the app config, shared by the threads '''
+    return RATE_BACKENDS.instance()
+
+
+class RateLimiter(object):
+    '''
+    Token bucket that paces the messages sent to a provider to its rate,
+    in messages per second, allowing bursts of up to burst messages. The
+    bucket is shared through the rate backend, so the waits of all the
+    threads and workers add up to the rate.
+    '''
+
+    def __init__(self, name, rate, burst, backend=None):
+        self.key = 'send-rate:%s' % name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.backend = backend
+
+    def delay(self, n=1):
+        '''
+        Reserves n messages, returning the seconds to wait before sending
+        them. The messages are reserved before waiting, so the callers are
+        served in order, as soon as the rate allows it.
+        '''
+        if not self.rate:
+            return 0
+        backend = self.backend or rate_backend()
+        return backend.reserve(self.key, n / self.rate, self.burst / self.rate)
+
+    def wait(self, n=1):
+        ''' Waits until n messages can be sent, see delay '''
+        delay = self.delay(n)
+        if delay:
+            time.sleep(delay)
+
+
+def rate_limiter(provider):
+    '''
+    Returns the rate limiter of a provider, an SMS_PROVIDER name or 'email',
+    configured in settings.SEND_RATES. Providers without rate aren't paced.
+    '''
+    conf = settings.SEND_RATES.get(provider, {})
+    return RateLimiter(provider, conf.get('rate', 0), conf.get('burst', 1))
+
+
+register_rate_backend('local', LocalRateBackend)
+register_rate_backend('cache', CacheRateBackend)
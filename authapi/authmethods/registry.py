@@ -0,0 +1,43 @@
+import threading
+from django.conf import settings
+
+
+# all the registries, so their instances can be reset together
+REGISTRIES = []
+
+
+class Registry(object):
+    '''
+    Classes registered by name, and the instance of the one named in a
+    setting of the app config. The instance is built the first time it's
+    used, and then shared by all the threads of the process.
+    '''
+
+    def __init__(self, setting):
+        self.setting = setting
+        self.classes = {}
+        self.lock = threading.Lock()
+        self._instance = None
+        REGISTRIES.append(self)
+
+    def register(self, name, klass):
+        ''' Registers a class, to be used with the setting = name '''
+        self.classes[name] = klass
+
+    def instance(self):
+        ''' Returns the instance of the class of the app config '''
+        instance = self._instance
+        if instance is not None:
+            return instance
+
+        with self.lock:
+            if self._instance is None:
+                name = getattr(settings, self.setting)
+                if name not in self.classes:
+                    raise Exception("invalid %s='%s' in app config" % (self.setting, name))
+                self._instance = self.classes[name]()
+            return self._instance
+
+    def reset(self):
+        ''' Drops the instance, so the next one is built with the settings '''
+        self._instance = None
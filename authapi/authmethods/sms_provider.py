@@ -16,10 +16,87 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import requests
 import logging
 import xmltodict
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+from xml.sax.saxutils import escape
+
+from .rate import rate_limiter
+from .registry import Registry
+
+
+# requests session shared by the providers, and the process that created it
+_session = None
+_session_pid = None
+
+def http_session():
+    '''
+    Returns the requests session of this process. The session is kept for
+    the life of the process, so the connections to the provider are kept
+    alive and reused instead of paying DNS, TCP and TLS setup on each sms.
+    A forked worker doesn't share the parent's connections, it creates its
+    own session.
+    '''
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=settings.SMS_HTTP_POOL_SIZE,
+                              pool_maxsize=settings.SMS_HTTP_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+
+# SMS provider classes by name, and the instance of the configured one
+PROVIDERS = Registry('SMS_PROVIDER')
+
+def register_provider(name, klass):
+    ''' Registers an SMS provider, to be used with SMS_PROVIDER = name '''
+    PROVIDERS.register(name, klass)
+
+
+@lru_cache(maxsize=settings.TLF_CACHE_SIZE)
+def canonical_format(tlf, prefix):
+    '''
+    Canonical format of a tlf number string, see
+    SMSProvider.get_canonical_format. It's memoized, because the same number
+    is converted several times while its census row is checked and created,
+    or while the voter registers or authenticates.
+    '''
+    if tlf.startswith("00"):
+      return "+" + tlf[2:]
+    elif tlf.startswith("+"):
+      return tlf
+    else: # add default prefix
+      return prefix + tlf
+
+
+def dispatch(func, items):
+    '''
+    Calls func with each item, keeping up to settings.SMS_CONCURRENCY calls
+    in flight in a pool of threads, because most of the time of a call is
+    spent waiting the provider response. Returns a (result, error) tuple for
+    each item, in the order of the items.
+    '''
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            logging.exception("error sending sms")
+            return None, e
+
+    workers = min(settings.SMS_CONCURRENCY, len(items))
+    if workers < 2:
+        return [call(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(call, items))
 
 
 class SMSProvider(object):
@@ -40,6 +117,21 @@ class SMSProvider(object):
         '''
         pass
 
+    def send_sms_batch(self, messages, is_audio=False):
+        '''
+        Sends a list of (receiver, content) messages, returning for each one
+        if it was sent. Providers that can send many messages in a request
+        override it, by default each message is sent with send_sms. The
+        messages are paced to the rate of the provider.
+        '''
+        limiter = self.rate_limiter()
+
+        def send(message):
+            receiver, content = message
+            limiter.wait()
+            self.send_sms(receiver=receiver, content=content, is_audio=is_audio)
+        return [error is None for result, error in dispatch(send, messages)]
+
     def get_credit(self):
         '''
         obtains the remaining credit. Note, each provider has it's own format
@@ -47,6 +139,23 @@ class SMSProvider(object):
         '''
         return 0
 
+    def rate_limiter(self):
+        ''' Rate limiter of the provider, see settings.SEND_RATES '''
+        return rate_limiter(self.provider_name)
+
+    def post(self, url, **kwargs):
+        '''
+        POST request to the provider through the process session, with the
+        connect and read timeouts in settings
+        '''
+        kwargs.setdefault('timeout', (settings.SMS_CONNECT_TIMEOUT, settings.SMS_READ_TIMEOUT))
+        return http_session().post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        ''' GET request to the provider, like post '''
+        kwargs.setdefault('timeout', (settings.SMS_CONNECT_TIMEOUT, settings.SMS_READ_TIMEOUT))
+        return http_session().get(url, **kwargs)
+
     def get_canonical_format(self, tlf):
         """
         converts a tlf number to a cannonical format. This means in practice
@@ -58,27 +167,24 @@ class SMSProvider(object):
         """
         if not isinstance(tlf, str):
             return tlf
-        if tlf.startswith("00"):
-          return "+" + tlf[2:]
-        elif tlf.startswith("+"):
-          return tlf
-        else: # add default prefix
-          return self.default_prefix + tlf
+        return canonical_format(tlf, self.default_prefix)
+
+    def get_canonical_formats(self, tlfs):
+        '''
+        converts a list of tlf numbers, like a census column, to the
+        cannonical format, like get_canonical_format does for each one.
+        '''
+        prefix = self.default_prefix
+        return [canonical_format(tlf, prefix) if isinstance(tlf, str) else tlf
+                for tlf in tlfs]
 
     @staticmethod
     def get_instance():
         '''
-        Instance the SMS provider specified in the app config
+        Returns the SMS provider specified in the app config. It's built the
+        first time and then shared by all the threads of the process.
         '''
-        provider = settings.SMS_PROVIDER
-        if provider == "altiria":
-            return AltiriaSMSProvider()
-        if provider == "esendex":
-            return EsendexSMSProvider()
-        if provider == "console":
-            return ConsoleSMSProvider()
-        else:
-            raise Exception("invalid SMS_PROVIDER='%s' in app config" % provider)
+        return PROVIDERS.instance()
 
 
 class ConsoleSMSProvider(SMSProvider):
@@ -133,12 +239,62 @@ class AltiriaSMSProvider(SMSProvider):
         }
 
         logging.debug("sending message.." + str(data))
-        r = requests.post(self.url, data=data, headers=self.headers)
+        r = self.post(self.url, data=data, headers=self.headers)
 
         ret = self.parse_response(r)
         logging.debug(ret)
         return ret
 
+    def send_sms_batch(self, messages, is_audio=False):
+        '''
+        Altiria sends the same content to many destinations in a request, so
+        the messages are grouped by content, up to settings.SMS_BATCH_SIZE
+        destinations for each request.
+        '''
+        groups = {}
+        for i, (receiver, content) in enumerate(messages):
+            groups.setdefault(content, []).append(i)
+
+        size = settings.SMS_BATCH_SIZE
+        chunks = []
+        for content, indexes in groups.items():
+            for start in range(0, len(indexes), size):
+                chunks.append((content, indexes[start:start + size]))
+
+        limiter = self.rate_limiter()
+
+        def send(chunk):
+            content, indexes = chunk
+            limiter.wait(len(indexes))
+            data = {
+                'cmd': 'sendsms',
+                'domainId': self.domain_id,
+                'login': self.login,
+                'passwd': self.password,
+                'dest': [messages[i][0] for i in indexes],
+                'msg': content,
+                'senderId': self.sender_id
+            }
+            logging.debug("sending messages.." + str(data))
+            r = self.post(self.url, data=data, headers=self.headers)
+            # the response has a line for each destination
+            return set(line.get('dest') for line in self.parse_response(r)['lines']
+                       if not line['error'])
+
+        results = [False] * len(messages)
+        for (content, indexes), (sent, error) in zip(chunks, dispatch(send, chunks)):
+            for i in indexes:
+                results[i] = error is None and self.response_dest(messages[i][0]) in sent
+        return results
+
+    def response_dest(self, receiver):
+        ''' Returns the receiver as it is in the responses, without + or 00 '''
+        if receiver.startswith('+'):
+            return receiver[1:]
+        if receiver.startswith('00'):
+            return receiver[2:]
+        return receiver
+
     def get_credit(self):
         data = {
             'cmd': 'getcredit',
@@ -147,7 +303,7 @@ class AltiriaSMSProvider(SMSProvider):
             'passwd': self.password,
 
         }
-        r = requests.post(self.url, data=data, headers=self.headers)
+        r = self.post(self.url, data=data, headers=self.headers)
 
         ret = self.parse_response(r)
         logging.debug(ret)
@@ -224,6 +380,21 @@ class EsendexSMSProvider(SMSProvider):
         </message>
         </messages>"""
 
+    # template xml of a batch of messages
+    batch_template = """<?xml version='1.0' encoding='UTF-8'?>
+        <messages>
+        <accountreference>%(accountreference)s</accountreference>
+        %(messages)s
+        </messages>"""
+
+    batch_msg_template = """<message>
+        <type>%(msg_type)s</type>
+        %(extra)s
+        <to>%(to)s</to>
+        <body>%(body)s</body>
+        <from>%(sender)s</from>
+        </message>"""
+
     def __init__(self):
         self.domain_id = settings.SMS_DOMAIN_ID
         self.login = settings.SMS_LOGIN
@@ -250,12 +421,78 @@ class EsendexSMSProvider(SMSProvider):
             sender=self.sender_id,
             extra=extra)
         logging.debug("sending message.." + str(data))
-        r = requests.post(self.url, data=data, headers=self.headers, auth=self.auth)
+        r = self.post(self.url, data=data, headers=self.headers, auth=self.auth)
 
         ret = self.parse_response(r)
         logging.debug(ret)
         return ret
 
+    def send_sms_batch(self, messages, is_audio=False):
+        '''
+        Esendex accepts many <message> elements in a request, so the messages
+        are sent in requests of settings.SMS_BATCH_SIZE messages. The response
+        has a <messageheader> for each accepted message, see accepted.
+        '''
+        if is_audio:
+            msg_type = 'Voice'
+            extra = "<lang>%s</lang>\n" % self.lang_code
+        else:
+            msg_type = 'SMS'
+            extra = ""
+
+        size = settings.SMS_BATCH_SIZE
+        chunks = [messages[start:start + size] for start in range(0, len(messages), size)]
+        limiter = self.rate_limiter()
+
+        def send(chunk):
+            limiter.wait(len(chunk))
+            data = self.batch_template % dict(
+                accountreference=self.domain_id,
+                messages="\n".join(self.batch_msg_template % dict(
+                    msg_type=msg_type,
+                    to=escape(receiver),
+                    body=escape(content),
+                    sender=self.sender_id,
+                    extra=extra) for receiver, content in chunk))
+            logging.debug("sending messages.." + str(data))
+            r = self.post(self.url, data=data.encode('utf-8'), headers=self.headers, auth=self.auth)
+            ret = self.parse_response(r)
+            headers = []
+            if 'messageheaders' in ret:
+                headers = (ret['messageheaders'] or {}).get('messageheader', [])
+                if not isinstance(headers, list):
+                    headers = [headers]
+            return self.accepted(chunk, headers)
+
+        results = []
+        for chunk, (accepted, error) in zip(chunks, dispatch(send, chunks)):
+            results.extend(accepted if error is None else [False] * len(chunk))
+        return results
+
+    def accepted(self, chunk, headers):
+        '''
+        Returns if each message of the chunk was accepted, given the
+        <messageheader> elements of the response. With a header for each
+        message all were accepted; otherwise the headers only have the id and
+        uri of the message, so each one is read from its uri to know its
+        recipient.
+        '''
+        if len(headers) == len(chunk):
+            return [True] * len(chunk)
+
+        recipients = Counter()
+        for header in headers:
+            r = self.get(header['@uri'], headers=self.headers, auth=self.auth)
+            ret = self.parse_response(r)
+            recipients[ret['messageheader']['to']['phonenumber'].lstrip('+')] += 1
+
+        results = []
+        for receiver, content in chunk:
+            number = receiver.lstrip('+')
+            results.append(recipients[number] > 0)
+            recipients[number] -= 1
+        return results
+
     def parse_response(self, response):
         '''
         parses responses in esendex format
@@ -269,3 +506,8 @@ class EsendexSMSProvider(SMSProvider):
             }
 
         return ret
+
+
+register_provider('console', ConsoleSMSProvider)
+register_provider('altiria', AltiriaSMSProvider)
+register_provider('esendex', EsendexSMSProvider)
@@ -1,16 +1,35 @@
 from django.contrib.auth.models import User
 from django.core import mail
-from django.test import TestCase
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory, TestCase
 from django.test.utils import override_settings
+from django.utils import timezone
 
 import json
+import re
+import shutil
+import tempfile
+import threading
 import time
+from datetime import timedelta
+from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
 from api import test_data
 from api.tests import JClient
 from api.models import AuthEvent, ACL
+from utils import send_codes
 from .m_email import Email
+from .audit import audit_buffer
+from .counters import WindowCounter
+from .rate import CacheRateBackend, LocalRateBackend, RateLimiter, rate_limiter
 from .m_sms import Sms
-from .models import Message, Code, Connection
+from .sms_provider import SMSProvider, register_provider
+from .models import ColorList, Message, Code, Connection
+from . import colorlist, utils
+from .colorlist import colorlist_index
+from .utils import AuthContext, compile_pipeline, create_user, get_cannonical_tlf, get_cannonical_tlfs
 
 
 class AuthMethodTestCase(TestCase):
@@ -50,6 +69,62 @@ class AuthMethodTestCase(TestCase):
         self.assertTrue(r['auth-token'].startswith('khmac:///sha-256'))
 
 
+    def test_create_user_queries(self):
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        ae.auth_method = 'email'
+        ae.extra_fields = [{'name': 'dni', 'type': 'text', 'unique': True}]
+        # transaction savepoint and release, and user, userdata and unique
+        # values inserts
+        with self.assertNumQueries(5):
+            u = create_user({'email': 'foo@test.com', 'dni': '11111111H'}, ae)
+        u = User.objects.get(pk=u.pk)
+        self.assertEqual(u.email, 'foo@test.com')
+        self.assertEqual(u.userdata.event, ae)
+        self.assertEqual(json.loads(u.userdata.metadata), {'dni': '11111111H'})
+        self.assertEqual(u.userdata.unique_values.count(), 1)
+
+
+    def test_create_user_username_collision(self):
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        ae.auth_method = 'email'
+        usernames = [[test_data.pwd_auth['username']], ['a' * 28]]
+        random_usernames = utils.random_usernames
+        utils.random_usernames = lambda n: usernames.pop(0)
+        try:
+            u = create_user({'email': 'foo@test.com'}, ae)
+        finally:
+            utils.random_usernames = random_usernames
+        self.assertEqual(u.username, 'a' * 28)
+        self.assertEqual(User.objects.filter(email='foo@test.com').count(), 1)
+        self.assertEqual(len(utils.random_usernames(100)), 100)
+
+
+    def test_compile_pipeline(self):
+        ae = AuthEvent(auth_method='sms', auth_method_config=test_data.authmethod_config_sms_default)
+        ae.save()
+        steps = compile_pipeline(ae)
+        self.assertEqual([s.func for s in steps], [utils.check_whitelisted,
+            utils.check_whitelisted, utils.check_blacklisted, utils.check_blacklisted,
+            utils.check_total_max, utils.check_total_max, utils.check_total_max])
+        self.assertEqual(steps[0].keywords, {'field': 'tlf'})
+
+        # another instance with the same pipeline takes the compiled one
+        same = AuthEvent.objects.get(pk=ae.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(compile_pipeline(same) is steps)
+
+        ae = AuthEvent.objects.get(pk=ae.pk)
+        ae.auth_method_config['pipeline']['register-pipeline'] = [['check_total_max', {'max': 2}]]
+        ae.save()
+        steps = compile_pipeline(AuthEvent.objects.get(pk=ae.pk))
+        self.assertEqual([(s.func, s.keywords) for s in steps], [(utils.check_total_max, {'max': 2})])
+        self.assertFalse(compile_pipeline(same) is steps)
+
+        ae.auth_method_config['pipeline']['register-pipeline'] = [['eval', {}]]
+        ae.save()
+        self.assertRaises(Exception, compile_pipeline, ae)
+
+
 class AuthMethodEmailTestCase(TestCase):
     fixtures = ['initial.json']
     def setUp(self):
@@ -121,6 +196,20 @@ class AuthMethodEmailTestCase(TestCase):
         r = json.loads(response.content.decode('utf-8'))
         self.assertTrue(r['auth-token'].startswith('khmac:///sha-256'))
 
+    def test_method_email_total_connection(self):
+        c = JClient()
+        data = {'email': 'test1@agoravoting.com', 'code': 'B' * 32}
+        for i in range(test_data.pipe_times):
+            response = c.authenticate(self.aeid, data)
+            r = json.loads(response.content.decode('utf-8'))
+            self.assertEqual(r['msg'], 'Invalid code.')
+
+        # the email is counted as authenticate reads it, without spaces
+        data = {'email': ' test1@agoravoting.com ', 'code': 'A' * 32}
+        response = c.authenticate(self.aeid, data)
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(r['error_codename'], 'check_total_connection')
+
     def test_method_email_authenticate_invalid_code(self):
         c = JClient()
         data = {
@@ -177,6 +266,144 @@ class AuthMethodSmsTestCase(TestCase):
         r = json.loads(response.content.decode('utf-8'))
         self.assertEqual(r['status'], 'ok')
 
+    @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
+                       CELERY_ALWAYS_EAGER=True,
+                       BROKER_BACKEND='memory')
+    def test_method_sms_register_context(self):
+        data = {'tlf': '666666667', 'email': 'test1@test.com', 'dni': '11111111H'}
+        request = RequestFactory().post('/api/auth-event/%d/register/' % self.aeid,
+                json.dumps(data), content_type='application/json',
+                REMOTE_ADDR='127.0.0.2')
+        ctx = AuthContext(request)
+        self.assertEqual((ctx.tlf, ctx.ip, ctx.code), ('+34666666667', '127.0.0.2', None))
+
+        # the method and its pipeline don't read the request again
+        ctx.request = None
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        self.assertEqual(Sms().register(ae, ctx), {'status': 'ok'})
+        self.assertEqual(User.objects.get(userdata__tlf='+34666666667').email, 'test1@test.com')
+
+    def test_colorlist_checks(self):
+        ColorList(key=ColorList.KEY_TLF, value='+34666666667',
+                  action=ColorList.ACTION_BLACKLIST, auth_event_id=self.aeid).save()
+
+        def check(ae, tlf, ip_addr):
+            data = {'tlf': tlf, 'ip_addr': ip_addr, 'auth_event': ae}
+            for step in (utils.check_tlf_whitelisted, utils.check_ip_whitelisted,
+                         utils.check_ip_blacklisted, utils.check_tlf_blacklisted):
+                if step(data):
+                    return 'blacklisted'
+            return 'whitelisted' if data.get('whitelisted') else 'ok'
+
+        # the color list is read once, and then checked without queries
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        self.assertEqual(check(ae, '+34666666667', '127.0.0.1'), 'blacklisted')
+        with self.assertNumQueries(0):
+            self.assertEqual(check(ae, '+34666666668', '127.0.0.1'), 'ok')
+            self.assertEqual(check(ae, '+34666666667', '127.0.0.1'), 'blacklisted')
+
+        # the changes are seen by the next request, which reads the auth event
+        ColorList(key=ColorList.KEY_IP, value='127.0.0.1',
+                  action=ColorList.ACTION_WHITELIST, auth_event_id=self.aeid).save()
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        self.assertEqual(check(ae, '+34666666667', '127.0.0.1'), 'whitelisted')
+        ColorList.objects.filter(key=ColorList.KEY_IP).delete()
+        ColorList(key=ColorList.KEY_IP, value='127.0.0.2',
+                  action=ColorList.ACTION_BLACKLIST, auth_event_id=self.aeid).save()
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        self.assertEqual(check(ae, '+34666666668', '127.0.0.2'), 'blacklisted')
+        self.assertEqual(check(ae, '+34666666668', '127.0.0.1'), 'ok')
+
+        # the blacklisted values of another auth event aren't taken
+        ae.pk += 1
+        self.assertEqual(check(ae, '+34666666667', '127.0.0.2'), 'ok')
+
+        # an auth event read before a change doesn't undo it when it's saved
+        stale = AuthEvent.objects.get(pk=self.aeid)
+        ColorList(key=ColorList.KEY_IP, value='127.0.0.3',
+                  action=ColorList.ACTION_BLACKLIST, auth_event_id=self.aeid).save()
+        admin = User(username=test_data.admin['username'])
+        admin.set_password(test_data.admin['password'])
+        admin.save()
+        ACL(user=admin.userdata, object_type='AuthEvent', perm='edit', object_id=self.aeid).save()
+        c = JClient()
+        c.authenticate(0, test_data.admin)
+        with patch('api.views.get_object_or_404', return_value=stale):
+            response = c.post('/api/auth-event/%d/%s/' % (self.aeid, 'stopped'), {})
+        self.assertEqual(response.status_code, 200)
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        self.assertEqual(ae.colorlist_version, stale.colorlist_version + 1)
+        self.assertEqual(check(ae, '+34666666668', '127.0.0.3'), 'blacklisted')
+
+    @override_settings(COLORLIST_INDEXES=2)
+    def test_colorlist_indexes(self):
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        for pk in range(self.aeid, self.aeid + 3):
+            ae.pk = pk
+            colorlist_index(ae)
+        self.assertEqual(list(colorlist._indexes), [self.aeid + 1, self.aeid + 2])
+
+    def total_max(self, tlf, **kwargs):
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        data = {'tlf': tlf, 'ip_addr': '127.0.0.1', 'auth_event': ae}
+        return 'blacklisted' if utils.check_total_max(data, **kwargs) else 'ok'
+
+    def test_check_total_max(self):
+        # the counter starts with the message of the tlf sent in the setUp,
+        # and then each check gets the event, the generation of its counters,
+        # the window and the incremented bucket, whatever the messages sent
+        self.assertEqual(self.total_max('+34666666666', field='tlf', max=3), 'ok')
+        with self.assertNumQueries(5):
+            self.assertEqual(self.total_max('+34666666666', field='tlf', max=3), 'ok')
+        self.assertEqual(self.total_max('+34666666666', field='tlf', max=3), 'blacklisted')
+        self.assertEqual(ColorList.objects.filter(value='+34666666666').count(), 1)
+        self.assertEqual(self.total_max('+34666666667', field='tlf', max=3), 'ok')
+
+        # the messages sent before the period aren't counted
+        Message.objects.update(created=timezone.now() - timedelta(days=2))
+        Message(tlf='+34666666668', auth_event_id=self.aeid).save()
+        Message.objects.filter(tlf='+34666666668').update(created=timezone.now() - timedelta(days=2))
+        self.assertEqual(self.total_max('+34666666668', field='tlf', max=1, period=3600), 'ok')
+        self.assertEqual(self.total_max('+34666666668', field='tlf', max=1, period=3600), 'blacklisted')
+
+    def test_check_total_max_cache(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'counters': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                         'LOCATION': location},
+        }
+        with self.settings(CACHES=caches, COUNTER_BACKEND='cache', COUNTER_CACHE='counters'):
+            self.assertEqual(self.total_max('+34666666666', field='tlf', max=2), 'ok')
+            self.assertEqual(self.total_max('+34666666666', field='tlf', max=2), 'blacklisted')
+
+        # a cache of each process would count each process on its own
+        with self.settings(CACHES=caches, COUNTER_BACKEND='cache', COUNTER_CACHE='default'):
+            self.assertRaises(ImproperlyConfigured, self.total_max, '+34666666666', field='tlf', max=2)
+
+    def window_counter(self):
+        counter = WindowCounter('test-window:%d' % self.aeid, period=0.4)
+        self.assertEqual([counter.hit(lambda: 2) for i in range(3)], [2, 3, 4])
+        time.sleep(0.5)
+        # the window is empty, so it's seeded again
+        self.assertEqual(counter.hit(lambda: 2), 2)
+        self.assertEqual(counter.hit(lambda: 2), 3)
+
+        counter = WindowCounter('test-forever:%d' % self.aeid)
+        self.assertEqual([counter.hit(lambda: 2) for i in range(3)], [2, 3, 4])
+
+    @override_settings(COUNTER_BUCKETS=4, COUNTER_TTL=0.3)
+    def test_window_counter(self):
+        self.window_counter()
+        # the counters without period expire too
+        time.sleep(0.4)
+        self.assertEqual(WindowCounter('test-forever:%d' % self.aeid).hit(lambda: 5), 5)
+
+    @override_settings(COUNTER_BUCKETS=4, COUNTER_BACKEND='local')
+    def test_window_counter_local(self):
+        self.window_counter()
+
     def test_method_sms_register_valid_dni(self):
         data = {'tlf': '+34666666666', 'code': 'AAAAAAAA', 'dni': '11111111H'}
         response = self.c.register(self.aeid, data)
@@ -231,6 +458,54 @@ class AuthMethodSmsTestCase(TestCase):
         r = json.loads(response.content.decode('utf-8'))
         self.assertEqual(r['msg'], 'Invalid code.')
 
+    def test_method_sms_total_connection(self):
+        # the successful attempts aren't counted
+        data = {'tlf': '+34666666666', 'code': 'AAAAAAAA', 'dni': '11111111H', 'email': 'test@test.com'}
+        for i in range(test_data.pipe_times + 1):
+            response = self.c.authenticate(self.aeid, data)
+            self.assertEqual(response.status_code, 200)
+
+        data['code'] = 'BBBBBBBB'
+        for i in range(test_data.pipe_times):
+            response = self.c.authenticate(self.aeid, data)
+            r = json.loads(response.content.decode('utf-8'))
+            self.assertEqual(r['msg'], 'Invalid code.')
+
+        # the failures are counted by tlf, so the right code is rejected too,
+        # also with spaces around the tlf
+        data['code'] = 'AAAAAAAA'
+        for tlf in ('+34666666666', ' +34666666666 '):
+            data['tlf'] = tlf
+            response = self.c.authenticate(self.aeid, data)
+            self.assertEqual(response.status_code, 400)
+            r = json.loads(response.content.decode('utf-8'))
+            self.assertEqual(r['error_codename'], 'check_total_connection')
+
+        # the ip isn't limited without ip_times
+        data['tlf'] = '+34700000001'
+        response = self.c.authenticate(self.aeid, data)
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(r['msg'], 'User not exist.')
+
+    def test_method_sms_total_connection_ip(self):
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        ae.auth_method_config['pipeline']['authenticate-pipeline'] = [
+            ['check_total_connection', {'times': 5, 'ip_times': 2}]]
+        ae.save()
+        data = {'code': 'AAAAAAAA', 'dni': '11111111H', 'email': 'test@test.com'}
+        for tlf in ('+34700000001', '+34700000002'):
+            data['tlf'] = tlf
+            response = self.c.authenticate(self.aeid, data)
+            r = json.loads(response.content.decode('utf-8'))
+            self.assertEqual(r['msg'], 'User not exist.')
+
+        data['tlf'] = '+34666666666'
+        response = self.c.authenticate(self.aeid, data)
+        r = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(r['error_codename'], 'check_total_connection')
+        response = self.c.authenticate(self.aeid, data, REMOTE_ADDR='127.0.0.2')
+        self.assertEqual(response.status_code, 200)
+
     def test_method_sms_get_perm(self): # Fix
         auth = { 'tlf': '+34666666666', 'code': 'AAAAAAAA',
                 'email': 'test@test.com', 'dni': '11111111H'}
@@ -269,3 +544,258 @@ class AuthMethodSmsTestCase(TestCase):
         }
         response = self.c.authenticate(self.aeid, data)
         self.assertEqual(response.status_code, 400)
+
+
+class StubSMSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def altiria_response(body):
+    dests = parse_qs(body.decode('utf-8'))['dest']
+    return ''.join('OK dest:%s \n' % dest.lstrip('+') for dest in dests)
+
+
+def esendex_response(url, body, accept=lambda to: True):
+    # the header of each accepted message has the uri to read its recipient
+    headers = ''.join('<messageheader id="1" uri="%smessageheaders/%s"/>' % (url, to.lstrip('+'))
+                      for to in re.findall(r'<to>(.*?)</to>', body.decode('utf-8')) if accept(to))
+    return '<messageheaders batchid="1">%s</messageheaders>' % headers
+
+
+def esendex_header(path):
+    to = path.rsplit('/', 1)[1]
+    return '<messageheader id="1"><to><phonenumber>%s</phonenumber></to></messageheader>' % to
+
+
+class StubSMSHandler(BaseHTTPRequestHandler):
+    ''' Sms provider, keeping the connections alive '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.client_address, body))
+        self.respond(self.server.respond(body))
+
+    def do_GET(self):
+        self.server.requests.append((self.client_address, self.path))
+        self.respond(esendex_header(self.path))
+
+    def respond(self, response):
+        response = response.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class SlowSMSProvider(SMSProvider):
+    ''' Fake provider that takes latency seconds to send each sms '''
+    provider_name = 'slow'
+    latency = 0.05
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def send_sms(self, receiver, content, is_audio):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+        if receiver == 'error':
+            raise Exception("invalid receiver")
+
+
+class SMSProviderTestCase(TestCase):
+    def setUp(self):
+        self.server = StubSMSServer(('127.0.0.1', 0), StubSMSHandler)
+        self.server.requests = []
+        self.server.respond = altiria_response
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_altiria_reuses_connection(self):
+        with self.settings(SMS_PROVIDER='altiria', SMS_URL=self.url):
+            for i in range(3):
+                provider = SMSProvider.get_instance()
+                r = provider.send_sms('+34666666666', 'code %d' % i, False)
+                self.assertFalse(r['lines'][0]['error'])
+        self.assertEqual(len(self.server.requests), 3)
+        clients = set(client for client, body in self.server.requests)
+        self.assertEqual(len(clients), 1)
+
+    @override_settings(SMS_BATCH_SIZE=2)
+    def test_altiria_batch(self):
+        messages = [('+34666666661', 'same'), ('+34666666662', 'other'),
+                    ('+34666666663', 'same'), ('+34666666664', 'same')]
+        with self.settings(SMS_PROVIDER='altiria', SMS_URL=self.url):
+            results = SMSProvider.get_instance().send_sms_batch(messages)
+        self.assertEqual(results, [True] * 4)
+        # two requests for the same content and one for the other
+        self.assertEqual(len(self.server.requests), 3)
+
+    @override_settings(SMS_BATCH_SIZE=2)
+    def test_esendex_batch(self):
+        messages = [('+3466666666%d' % i, 'code <%d>' % i) for i in range(3)]
+        with self.settings(SMS_PROVIDER='esendex', SMS_URL=self.url):
+            provider = SMSProvider.get_instance()
+            self.server.respond = lambda body: esendex_response(self.url, body)
+            self.assertEqual(provider.send_sms_batch(messages), [True] * 3)
+            self.assertEqual(len(self.server.requests), 2)
+            # the requests are sent concurrently, in any order
+            bodies = b''.join(body for client, body in self.server.requests)
+            self.assertTrue(b'<body>code &lt;0&gt;</body>' in bodies)
+
+            # only the second message of the first request is accepted, and
+            # its header is read to know it
+            self.server.requests = []
+            self.server.respond = lambda body: esendex_response(
+                self.url, body, lambda to: to == '+34666666661')
+            self.assertEqual(provider.send_sms_batch(messages), [False, True, False])
+            self.assertEqual(sorted(body for client, body in self.server.requests
+                                    if isinstance(body, str)), ['/messageheaders/34666666661'])
+
+    def test_concurrent_batch(self):
+        messages = [('+3466666666%d' % i, 'code') for i in range(16)]
+        messages[5] = ('error', 'code')
+        elapsed = {}
+        for concurrency in (1, 8):
+            provider = SlowSMSProvider()
+            with self.settings(SMS_CONCURRENCY=concurrency):
+                start = time.time()
+                results = provider.send_sms_batch(messages)
+                elapsed[concurrency] = time.time() - start
+            self.assertEqual(results, [i != 5 for i in range(16)])
+            self.assertEqual(provider.max_in_flight, concurrency)
+        self.assertTrue(elapsed[8] * 2 < elapsed[1])
+
+    def test_registry_instance(self):
+        register_provider('slow', SlowSMSProvider)
+        with self.settings(SMS_PROVIDER='slow'):
+            instances = []
+            threads = [threading.Thread(target=lambda: instances.append(SMSProvider.get_instance()))
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(isinstance(instances[0], SlowSMSProvider))
+            self.assertEqual(len(set(id(i) for i in instances)), 1)
+            self.assertTrue(SMSProvider.get_instance() is instances[0])
+        self.assertFalse(isinstance(SMSProvider.get_instance(), SlowSMSProvider))
+
+        with self.settings(SMS_PROVIDER='invalid'):
+            self.assertRaises(Exception, SMSProvider.get_instance)
+
+    def test_canonical_tlfs(self):
+        tlfs = ['666666666', '+34666666666', '0034666666666', None, '+44777777777']
+        expected = [get_cannonical_tlf(tlf) for tlf in tlfs]
+        self.assertEqual(expected[:3], ['+34666666666'] * 3)
+        self.assertEqual(get_cannonical_tlfs(tlfs), expected)
+
+
+class RateLimiterTestCase(TestCase):
+    def delays(self, backend):
+        ''' Delays of the messages sent at 100 per second, in bursts of 5 '''
+        now = [1000.0]
+        backend.clock = lambda: now[0]
+        limiter = RateLimiter('test', 100, 5, backend)
+        delays = [limiter.delay() for i in range(8)]
+        # the burst is sent at once, and the rest at 100 per second
+        self.assertEqual([round(d, 3) for d in delays], [0] * 5 + [0.01, 0.02, 0.03])
+        now[0] += 0.05
+        self.assertEqual(round(limiter.delay(2), 3), 0.0)
+        self.assertEqual(round(limiter.delay(), 3), 0.01)
+
+    def test_local(self):
+        self.delays(LocalRateBackend())
+
+    def test_cache(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'rates': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                      'LOCATION': location},
+        }
+        with self.settings(CACHES=caches, SEND_RATE_CACHE='rates'):
+            self.delays(CacheRateBackend())
+
+        # a cache of each process would pace each process on its own
+        with self.settings(CACHES=caches, SEND_RATE_CACHE='default'):
+            self.assertRaises(ImproperlyConfigured, CacheRateBackend)
+
+    def test_not_paced(self):
+        limiter = rate_limiter('email')
+        self.assertEqual([limiter.delay(100) for i in range(4)], [0] * 4)
+
+    @override_settings(SEND_RATES={'slow': {'rate': 50, 'burst': 1}})
+    def test_provider_batch(self):
+        provider = SlowSMSProvider()
+        provider.latency = 0
+        self.assertEqual(provider.rate_limiter().rate, 50)
+        waits = []
+        class Limiter(object):
+            def wait(self, n=1):
+                waits.append(n)
+        provider.rate_limiter = Limiter
+        messages = [('+3466666666%d' % i, 'code') for i in range(10)]
+        self.assertEqual(provider.send_sms_batch(messages), [True] * 10)
+        self.assertEqual(waits, [1] * 10)
+
+
+class AuditBufferTestCase(TestCase):
+    def tearDown(self):
+        audit_buffer.flush()
+
+    @override_settings(AUDIT_BUFFER_SIZE=3, AUDIT_BUFFER_AGE=60)
+    def test_flush_size(self):
+        for i in range(2):
+            audit_buffer.add(Message(tlf='+3466666666%d' % i, auth_event_id=1))
+        audit_buffer.add(Connection(ip='127.0.0.1', tlf='+34666666660', auth_event_id=1))
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(Connection.objects.count(), 1)
+
+        audit_buffer.add(Message(tlf='+34666666662', auth_event_id=1))
+        self.assertEqual(Message.objects.count(), 2)
+        audit_buffer.flush()
+        self.assertEqual(Message.objects.count(), 3)
+
+    @override_settings(AUDIT_BUFFER_SIZE=100, AUDIT_BUFFER_AGE=0.05)
+    def test_flush_age(self):
+        audit_buffer.add(Message(tlf='+34666666660', auth_event_id=1))
+        self.assertEqual(Message.objects.count(), 0)
+        time.sleep(0.06)
+        audit_buffer.add(Message(tlf='+34666666661', auth_event_id=1))
+        self.assertEqual(Message.objects.count(), 2)
+
+    @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
+                       CELERY_ALWAYS_EAGER=True,
+                       BROKER_BACKEND='memory',
+                       AUDIT_BUFFER_SIZE=100, AUDIT_BUFFER_AGE=60)
+    def test_flush_task_end(self):
+        ae = AuthEvent(auth_method='sms', auth_method_config=test_data.authmethod_config_sms_default,
+                       status='started', census='open')
+        ae.save()
+        users = []
+        for i in range(3):
+            u = User(username='test%d' % i)
+            u.save()
+            u.userdata.event = ae
+            u.userdata.tlf = '+3466666666%d' % i
+            u.userdata.save()
+            users.append(u.pk)
+        send_codes.apply_async(args=[users])
+        self.assertEqual(Message.objects.filter(auth_event_id=ae.pk).count(), 3)
@@ -2,13 +2,21 @@ import json
 import re
 import os
 import binascii
+import hashlib
 from datetime import timedelta
+from functools import lru_cache, partial, reduce
+from operator import or_
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.http import HttpResponse
 from django.utils import timezone
-from .models import ColorList, Message, Code
-from api.models import ACL
+from .audit import audit_buffer
+from .colorlist import colorlist_index
+from .counters import WindowCounter, event_counters
+from .models import ColorList, Connection, Message, Code
+from api.models import ACL, UniqueValue, UserData
 from captcha.models import Captcha
 from captcha.decorators import valid_captcha
 
@@ -35,13 +43,34 @@ def error(message="", status=400, field=None, error_codename=None):
 
 
 def random_username():
-    # 30 hex digits random username
-    username = binascii.b2a_hex(os.urandom(14))
-    try:
-        User.objects.get(username=username)
-        return random_username()
-    except User.DoesNotExist:
-        return username;
+    # 28 hex digits random username, not checked against the database, see
+    # insert_with_usernames
+    return binascii.b2a_hex(os.urandom(14)).decode('ascii')
+
+
+def random_usernames(n):
+    ''' Returns n different random usernames for bulk inserts '''
+    usernames = set()
+    while len(usernames) < n:
+        usernames.add(random_username())
+    return list(usernames)
+
+
+def insert_with_usernames(users, insert, retries=3):
+    '''
+    Gives random usernames to the new users and calls insert in a
+    transaction. A username that is already used makes the unique constraint
+    fail, and then the insert is retried with new usernames.
+    '''
+    for retry in range(retries):
+        for u, username in zip(users, random_usernames(len(users))):
+            u.username = username
+        try:
+            with transaction.atomic():
+                return insert()
+        except IntegrityError:
+            if retry == retries - 1:
+                raise
 
 
 def get_client_ip(request):
@@ -53,6 +82,25 @@ def get_client_ip(request):
     return ip
 
 
+class AuthContext(object):
+    '''
+    Request to an auth method, parsed once. The json body, the client ip and
+    the tlf in canonical format are read when it's created, and then shared
+    by the auth method and its pipeline steps.
+    '''
+
+    def __init__(self, request):
+        self.request = request
+        self.req = json.loads(request.body.decode('utf-8'))
+        self.ip = get_client_ip(request)
+        self.tlf = self.req.get('tlf', None)
+        if isinstance(self.tlf, str):
+            self.tlf = self.tlf.strip()
+        if self.tlf:
+            self.tlf = get_cannonical_tlf(self.tlf)
+        self.code = self.req.get('code', None)
+
+
 def email_constraint(val):
     ''' check that the input is an email string '''
     if not isinstance(val, str):
@@ -86,20 +134,25 @@ def dni_constraint(val):
     return letter == expected
 
 # Pipeline
+def colorlist(data):
+    ''' Color list index of the auth event, read once for each pipeline run '''
+    if 'colorlist' not in data:
+        data['colorlist'] = colorlist_index(data['auth_event'])
+    return data['colorlist']
+
+
 def check_tlf_whitelisted(data):
     ''' If tlf is whitelisted, accept '''
     if data.get('whitelisted', False) == True:
         return RET_PIPE_CONTINUE
 
     tlf = data['tlf']
-    try:
-        item = ColorList.objects.get(key=ColorList.KEY_TLF, value=tlf, auth_event_id=data['auth_event'].id)
-        if item.action == ColorList.ACTION_WHITELIST:
-            data['whitelisted'] = True
-        else:
-            data["tlf_blacklisted"] = True
-    except:
-        data["tlf_blacklisted"] = False
+    index = colorlist(data)
+    if index.contains(ColorList.KEY_TLF, ColorList.ACTION_WHITELIST, tlf):
+        data['whitelisted'] = True
+    else:
+        data["tlf_blacklisted"] = index.contains(ColorList.KEY_TLF,
+                ColorList.ACTION_BLACKLIST, tlf)
     return RET_PIPE_CONTINUE
 
 
@@ -111,15 +164,8 @@ def check_ip_whitelisted(data):
         return RET_PIPE_CONTINUE
 
     ip_addr = data['ip_addr']
-    try:
-        item = ColorList.objects.filter(key=ColorList.KEY_IP, value=ip_addr,
-                                        auth_event_id=data['auth_event'].id)
-        for item in items:
-            if item.action == ColorList.ACTION_WHITELIST:
-                data['whitelisted'] = True
-                break
-    except:
-        pass
+    if colorlist(data).contains(ColorList.KEY_IP, ColorList.ACTION_WHITELIST, ip_addr):
+        data['whitelisted'] = True
     return RET_PIPE_CONTINUE
 
 
@@ -129,45 +175,50 @@ def check_tlf_blacklisted(data):
         return RET_PIPE_CONTINUE
 
     # optimization: if we have already gone through the whitelisting checking
-    # we don't have do new queries
+    # we don't have do new lookups
     if 'tlf_blacklisted' in data:
         if data['tlf_blacklisted']:
             return error("Blacklisted", error_codename="blacklisted")
         return RET_PIPE_CONTINUE
 
     tlf = data['tlf']
-    try:
-        item = ColorList.objects.filter(key=ColorList.KEY_TLF, value=tlf,
-                action=ColorList.ACTION_BLACKLIST, auth_event_id=data['auth_event'].id)[0]
+    if colorlist(data).contains(ColorList.KEY_TLF, ColorList.ACTION_BLACKLIST, tlf):
         return error("Blacklisted", error_codename="blacklisted")
-    except:
-        pass
     return RET_PIPE_CONTINUE
 
 
 def check_ip_blacklisted(data):
-    ''' check if tlf is blacklisted '''
+    ''' check if ip is blacklisted '''
     if data.get('whitelisted', False) == True:
         return RET_PIPE_CONTINUE
 
-    # optimization: if we have already gone through the whitelisting checking
-    # we don't have do new queries
-    if 'ip_blacklisted' in data:
-        if data['ip_blacklisted'] is True:
-            return error("Blacklisted", error_codename="blacklisted")
-        return RET_PIPE_CONTINUE
-
     ip_addr = data['ip_addr']
-    try:
-        item = ColorList.objects.filter(key=ColorList.KEY_IP, value=ip_addr,
-                action=ColorList.ACTION_BLACKLIST,
-                auth_event_id=data['auth_event'].id)[0]
+    if colorlist(data).contains(ColorList.KEY_IP, ColorList.ACTION_BLACKLIST, ip_addr):
         return error("Blacklisted", error_codename="blacklisted")
-    except:
-        pass
     return RET_PIPE_CONTINUE
 
 
+def counters(data):
+    ''' Prefix of the counters of the auth event, read once for each pipeline run '''
+    if 'counters' not in data:
+        data['counters'] = event_counters(data['auth_event'].id)
+    return data['counters']
+
+
+def messages_sent(data, period=None, **filters):
+    '''
+    Returns a function that counts the messages sent in the auth event that
+    match the filters, in the last period seconds, to seed a counter.
+    '''
+    def count():
+        messages = Message.objects.filter(auth_event_id=data['auth_event'].id, **filters)
+        if period:
+            time_threshold = timezone.now() - timedelta(seconds=period)
+            messages = messages.filter(created__gt=time_threshold)
+        return messages.count()
+    return count
+
+
 def check_tlf_total_max(data, **kwargs):
     '''
     if tlf has been sent >= MAX_SMS_LIMIT (in a period time) failed-sms
@@ -180,14 +231,8 @@ def check_tlf_total_max(data, **kwargs):
 
     ip_addr = data['ip_addr']
     tlf = data['tlf']
-    if period:
-        time_threshold = timezone.now() - timedelta(seconds=period)
-        # Fix
-        item = Message.objects.filter(tlf=tlf, created__lt=time_threshold,
-                                      auth_event_id=data['auth_event'].id)
-    else:
-        item = Message.objects.filter(tlf=tlf, auth_event_id=data['auth_event'].id)
-    if len(item) >= total_max:
+    counter = WindowCounter('%s:total-max:tlf:%s:%s' % (counters(data), period or 0, tlf), period)
+    if counter.hit(messages_sent(data, period, tlf=tlf)) >= total_max:
         c1 = ColorList(action=ColorList.ACTION_BLACKLIST,
                        key=ColorList.KEY_IP, value=ip_addr,
                        auth_event_id=data['auth_event'].id)
@@ -203,15 +248,16 @@ def check_tlf_total_max(data, **kwargs):
 def check_ip_total_max(data, **kwargs):
     '''
     if the ip has been sent more than <total_max> messages that have not been
-    authenticated, blacklist it
+    authenticated (in a period time), blacklist it
     '''
     total_max = kwargs.get('max')
+    period = kwargs.get('period')
     if data.get('whitelisted', False) == True:
         return RET_PIPE_CONTINUE
 
     ip_addr = data['ip_addr']
-    item = Message.objects.filter(ip=ip_addr, auth_event_id=data['auth_event'].id)
-    if len(item) >= total_max:
+    counter = WindowCounter('%s:total-max:ip:%s:%s' % (counters(data), period or 0, ip_addr), period)
+    if counter.hit(messages_sent(data, period, ip=ip_addr)) >= total_max:
         cl = ColorList(action=ColorList.ACTION_BLACKLIST,
                        key=ColorList.KEY_IP, value=ip_addr,
                        auth_event_id=data['auth_event'].id)
@@ -250,38 +296,119 @@ def check_blacklisted(data, **kwargs):
 
 
 def check_total_max(data, **kwargs):
-    check = check_tlf_total_max(data, **kwargs)
-    if check != 0:
-        return check
-    check = check_ip_total_max(data, **kwargs)
-    return check
+    ''' Checks the field of the step, or both the tlf and ip without field '''
+    field = kwargs.get('field')
+    if field in (None, 'tlf'):
+        check = check_tlf_total_max(data, **kwargs)
+        if check != 0:
+            return check
+    if field in (None, 'ip'):
+        return check_ip_total_max(data, **kwargs)
+    return RET_PIPE_CONTINUE
+
+
+def connection_counters(data, **kwargs):
+    '''
+    Returns the counters of the failed authentications checked by
+    check_total_connection, with the max of each one: the tlf or email can
+    fail <times> times, and the ip <ip_times> times if it's given, because
+    many voters can share an ip.
+    '''
+    period = kwargs.get('period')
+    result = []
+    # the tlf and email are normalized like authenticate does, so spaces
+    # don't make another counter
+    user = data.get('tlf') or data.get('email')
+    if isinstance(user, str) and user.strip():
+        user = user.strip().lower()
+        key = '%s:connection:user:%s:%s' % (counters(data), period or 0, user)
+        result.append((WindowCounter(key, period), kwargs.get('times')))
+    if kwargs.get('ip_times'):
+        key = '%s:connection:ip:%s:%s' % (counters(data), period or 0, data['ip_addr'])
+        result.append((WindowCounter(key, period), kwargs.get('ip_times')))
+    return result
 
 
 def check_total_connection(data, **kwargs):
-    conn = Connection.objects.filter(tlf=req.get('tlf'),
-                                     auth_event_id=data['auth_event'].id).count()
-    if conn >= kwargs.get('times'):
-        return error('Exceeded the level os attempts',
-                error_codename='check_total_connection')
-    conn = Connection(ip=data['ip'], tlf=data['tlf'])
-    conn.save()
+    '''
+    if the tlf or email, or the ip, has failed to authenticate <times> times
+    (in a period time), error. The failures are counted by failed_connection,
+    and the connection is only kept in the audit buffer.
+    '''
+    for counter, times in connection_counters(data, **kwargs):
+        if counter.count() >= times:
+            return error('Exceeded the level of attempts',
+                    error_codename='check_total_connection')
+    audit_buffer.add(Connection(ip=data['ip_addr'], tlf=data.get('tlf') or '',
+                                auth_event_id=data['auth_event'].id))
     return RET_PIPE_CONTINUE
 
 
-def check_pipeline(request, ae, step='register'):
-    req = json.loads(request.body.decode('utf-8'))
-    if req.get('tlf'):
-        req['tlf'] = get_cannonical_tlf(req['tlf'])
-    data = {
-        'ip_addr': get_client_ip(request),
-        'tlf': req.get('tlf', None),
-        'code': req.get('code', None),
+def failed_connection(ctx, ae):
+    '''
+    Counts a failed authentication in the counters of the
+    check_total_connection steps of the authenticate pipeline
+    '''
+    data = pipeline_data(ctx, ae)
+    for name, kwargs in ae.auth_method_config.get('pipeline').get('authenticate-pipeline', []):
+        if name == 'check_total_connection':
+            for counter, times in connection_counters(data, **kwargs):
+                counter.hit()
+
+
+# pipeline steps by name, as they are given in the auth method config
+PIPELINE_STEPS = {}
+
+def register_pipeline_step(name, func):
+    ''' Registers a pipeline step, to be used in the pipelines by name '''
+    PIPELINE_STEPS[name] = func
+
+
+register_pipeline_step('check_whitelisted', check_whitelisted)
+register_pipeline_step('check_blacklisted', check_blacklisted)
+register_pipeline_step('check_total_max', check_total_max)
+register_pipeline_step('check_total_connection', check_total_connection)
+register_pipeline_step('check_sms_code', check_sms_code)
+
+
+def compile_pipeline(ae, step='register'):
+    '''
+    Returns the steps of a pipeline of the auth event, as callables with
+    their arguments already bound. The pipeline is compiled once for each
+    config, and then it's taken from the cache, so an auth event whose
+    pipeline changes gets it compiled again.
+    '''
+    pipeline = ae.auth_method_config.get('pipeline').get('%s-pipeline' % step)
+    return _compile_pipeline(json.dumps(pipeline, sort_keys=True))
+
+
+@lru_cache(maxsize=settings.PIPELINE_CACHE_SIZE)
+def _compile_pipeline(pipeline):
+    steps = []
+    for name, kwargs in json.loads(pipeline):
+        if name not in PIPELINE_STEPS:
+            raise Exception("invalid pipeline step '%s'" % name)
+        steps.append(partial(PIPELINE_STEPS[name], **kwargs))
+    return tuple(steps)
+
+
+def pipeline_data(ctx, ae):
+    ''' Data of the context given to the pipeline steps '''
+    return {
+        'ip_addr': ctx.ip,
+        'tlf': ctx.tlf,
+        'email': ctx.req.get('email', None),
+        'code': ctx.code,
         'auth_event': ae
     }
 
-    pipeline = ae.auth_method_config.get('pipeline').get('%s-pipeline' % step)
-    for pipe in pipeline:
-        check = getattr(eval(pipe[0]), '__call__')(data, **pipe[1])
+
+def check_pipeline(ctx, ae, step='register'):
+    ''' Runs a pipeline of the auth event with the data of the context '''
+    data = pipeline_data(ctx, ae)
+
+    for pipe in compile_pipeline(ae, step):
+        check = pipe(data)
         if check:
             data.update(json.loads(check.content.decode('utf-8')))
             data['status'] = check.status_code
@@ -289,6 +416,8 @@ def check_pipeline(request, ae, step='register'):
                 data.pop('auth_event')
             if data.get('code'):
                 data.pop('code')
+            data.pop('colorlist', None)
+            data.pop('counters', None)
             return data
     return RET_PIPE_CONTINUE
 
@@ -379,12 +508,54 @@ def have_captcha(ae, step='register'):
     return False
 
 
-def metadata_repeat(req, user, uniques):
-    for unique in uniques:
-        metadata = json.loads(user.userdata.metadata)
-        if metadata.get(unique.get('name')) == req.get(unique.get('name')):
-            return "%s %s repeat." % (unique.get('name'), req.get(unique.get('name')))
-    return ''
+def unique_fields(ae):
+    ''' Returns the names of the unique extra fields of the auth event '''
+    return [extra.get('name') for extra in ae.extra_fields or []
+            if extra.get('unique')]
+
+
+def unique_value(value):
+    '''
+    Normalizes the value of a unique field to the string stored in the
+    UniqueValue table. Long values are stored as their hash.
+    '''
+    value = json.dumps(value, sort_keys=True, ensure_ascii=False)
+    if len(value) > 255:
+        value = 'sha256:' + hashlib.sha256(value.encode('utf-8')).hexdigest()
+    return value
+
+
+def unique_values(userdata, metadata, ae):
+    ''' Returns the unsaved UniqueValue rows of the user metadata '''
+    values = []
+    for name in unique_fields(ae):
+        if metadata.get(name) is not None:
+            values.append(UniqueValue(user=userdata, event=ae, name=name,
+                                      value=unique_value(metadata.get(name))))
+    return values
+
+
+def update_unique_values(userdata, metadata, ae):
+    ''' Replaces the UniqueValue rows of the user with the metadata ones '''
+    if not unique_fields(ae):
+        return
+    UniqueValue.objects.filter(user=userdata).delete()
+    UniqueValue.objects.bulk_create(unique_values(userdata, metadata, ae))
+
+
+def reindex_unique_values(ae):
+    '''
+    Rebuilds the UniqueValue rows of the auth event from the users metadata,
+    needed when the unique extra fields of the auth event change.
+    '''
+    from api.models import UserData
+    UniqueValue.objects.filter(event=ae).delete()
+    if not unique_fields(ae):
+        return
+    values = []
+    for ud in UserData.objects.filter(event=ae).only('metadata').iterator():
+        values.extend(unique_values(ud, json.loads(ud.metadata), ae))
+    UniqueValue.objects.bulk_create(values)
 
 
 def exist_user(req, ae, get_repeated=False):
@@ -404,16 +575,14 @@ def exist_user(req, ae, get_repeated=False):
             pass
 
     if not msg:
-        if not ae.extra_fields:
-            return ''
-        uniques = []
-        for extra in ae.extra_fields:
-            if 'unique' in extra.keys() and extra.get('unique'):
-                uniques.append(extra)
-        for user in User.objects.filter(userdata__event=ae):
-            msg += metadata_repeat(req, user, uniques)
-            if msg:
-                break
+        uniques = [Q(name=name, value=unique_value(req.get(name)))
+                   for name in unique_fields(ae) if req.get(name) is not None]
+        if uniques:
+            repeated = UniqueValue.objects.filter(reduce(or_, uniques), event=ae)\
+                    .select_related('user__user').first()
+            if repeated:
+                user = repeated.user.user
+                msg += "%s %s repeat." % (repeated.name, req.get(repeated.name))
     if not msg:
         return ''
     if get_repeated:
@@ -427,15 +596,28 @@ def get_cannonical_tlf(tlf):
     return con.get_canonical_format(tlf)
 
 
-def edit_user(user, req, ae):
+def get_cannonical_tlfs(tlfs):
+    ''' Converts a list of tlf numbers, with one call to the provider '''
+    from authmethods.sms_provider import SMSProvider
+    con = SMSProvider.get_instance()
+    return con.get_canonical_formats(tlfs)
+
+
+def set_user_fields(user, userdata, req, ae, hash_password=True):
+    '''
+    Fills user and userdata with the fields of the request, without saving
+    them. The fields that are not stored in the user or userdata columns are
+    kept as metadata. With hash_password disabled, the raw password is left
+    in user.password to be hashed by the caller.
+    '''
     if ae.auth_method == 'email':
         user.email = req.get('email')
         req.pop('email')
     elif ae.auth_method == 'sms':
         if req['tlf']:
-            user.userdata.tlf = get_cannonical_tlf(req['tlf'])
+            userdata.tlf = get_cannonical_tlf(req['tlf'])
         else:
-            user.userdata.tlf = req['tlf']
+            userdata.tlf = req['tlf']
         req.pop('tlf')
     if ae.extra_fields:
         for extra in ae.extra_fields:
@@ -444,27 +626,46 @@ def edit_user(user, req, ae):
                 req.pop(extra.get('name'))
             elif extra.get('type') == 'tlf':
                 if req[extra.get('name')]:
-                    user.userdata.tlf = get_cannonical_tlf(req[extra.get('name')])
+                    userdata.tlf = get_cannonical_tlf(req[extra.get('name')])
                 else:
-                    user.userdata.tlf = req[extra.get('name')]
+                    userdata.tlf = req[extra.get('name')]
                 req.pop(extra.get('name'))
             elif extra.get('type') == 'password':
-                user.set_password(req.get(extra.get('name')))
+                if hash_password:
+                    user.set_password(req.get(extra.get('name')))
+                else:
+                    user.password = req.get(extra.get('name'))
                 req.pop(extra.get('name'))
+    userdata.metadata = json.dumps(req)
+
+
+def edit_user(user, req, ae):
+    set_user_fields(user, user.userdata, req, ae)
     user.save()
-    user.userdata.metadata = json.dumps(req)
     user.userdata.save()
+    update_unique_values(user.userdata, req, ae)
     return user
 
 
 def create_user(req, ae, active=False):
-    user = random_username()
-    u = User(username=user)
+    '''
+    Creates the user with its userdata already filled, so it's only one
+    insert for each table. The create_user_data signal is skipped because
+    the userdata is given.
+    '''
+    u = User()
     u.is_active = active
-    u.save()
-    u.userdata.event = ae
-    u.userdata.save()
-    return edit_user(u, req, ae)
+    ud = UserData(event=ae)
+    set_user_fields(u, ud, req, ae)
+    u.skip_userdata = True
+
+    def insert():
+        u.save()
+        ud.user = u
+        ud.save()
+        UniqueValue.objects.bulk_create(unique_values(ud, req, ae))
+    insert_with_usernames([u], insert)
+    return u
 
 
 def check_metadata(req, user):
@@ -495,8 +696,16 @@ def give_perms(u, ae):
     pipe = ae.auth_method_config.get('pipeline')
     if not pipe:
         return 'Bad config'
-    give_perms = pipe.get('give_perms', [])
-    for perms in give_perms:
+    for acl in perms_acls(u, u.userdata, ae):
+        acl.save()
+    return ''
+
+
+def perms_acls(u, userdata, ae):
+    ''' Returns the unsaved ACLs given by the give_perms pipeline to u '''
+    pipe = ae.auth_method_config.get('pipeline') or {}
+    acls = []
+    for perms in pipe.get('give_perms', []):
         obj = perms.get('object_type')
         obj_id = perms.get('object_id', 0)
         if obj_id == 'UserDataId':
@@ -504,6 +713,5 @@ def give_perms(u, ae):
         elif obj_id == 'AuthEventId':
             obj_id = ae.pk
         for perm in perms.get('perms'):
-            acl = ACL(user=u.userdata, object_type=obj, perm=perm, object_id=obj_id)
-            acl.save()
-    return ''
+            acls.append(ACL(user=userdata, object_type=obj, perm=perm, object_id=obj_id))
+    return acls
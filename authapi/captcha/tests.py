@@ -76,7 +76,7 @@ class TestProcessCaptcha(TestCase):
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 4)
 
         # add register: without captcha
@@ -135,7 +135,7 @@ class TestProcessCaptcha(TestCase):
         self.assertEqual(response.status_code, 200)
         response = c.get('/api/auth-event/%d/census/' % self.aeid, {})
         self.assertEqual(response.status_code, 200)
-        r = json.loads(response.content.decode('utf-8'))
+        r = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         self.assertEqual(len(r['userids']), 4)
 
         # add register: without captcha
@@ -5,9 +5,8 @@ import json
 import time
 import six
 from djcelery import celery
-from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
-from django.core.mail import send_mail, EmailMessage
+from django.core.mail import send_mail, EmailMessage, get_connection
 from django.core.paginator import Paginator
 from django.conf import settings
 from string import ascii_lowercase, digits, ascii_letters
@@ -134,10 +133,12 @@ def constant_time_compare(val1, val2):
 def random_code(length=16, chars=ascii_lowercase+digits):
     return ''.join([choice(chars) for i in range(length)])
 
+CODE_CHARS = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+
 def generate_code(userdata, size=settings.SIZE_CODE):
     """ Generate necessary codes for different authmethods. """
     from authmethods.models import Code
-    code = random_code(size, "ABCDEFGHJKLMNPQRSTUVWXYZ23456789")
+    code = random_code(size, CODE_CHARS)
     c = Code(user=userdata, code=code, auth_event_id=userdata.event.id)
     c.save()
     return code
@@ -161,12 +162,6 @@ def send_mail(subject, msg, receiver):
     send_email(email)
 
 
-def send_sms_code(receiver, msg, conf):
-    from authmethods.sms_provider import SMSProvider
-    con = SMSProvider.get_instance()
-    con.send_sms(receiver=receiver, content=msg, is_audio=False)
-
-
 def send_code(user, config=None):
     '''
     Sends the code for authentication in the related auth event, to the user
@@ -178,67 +173,129 @@ def send_code(user, config=None):
 
     NOTE: You are responsible of not calling this on a stopped auth event
     '''
-    from authmethods.models import Message
-    auth_method = user.userdata.event.auth_method
-    conf = user.userdata.event.auth_method_config.get('config')
-    event_id = user.userdata.event.id
+    return send_user_codes([user.id], config)
 
-    # if blank tlf or email
-    if auth_method == "sms" and not user.userdata.tlf:
-        return
-    elif auth_method == "email" and not user.email:
-        return
 
-    code = generate_code(user.userdata)
+def send_user_codes(users, config=None):
+    '''
+    Sends the codes to the users, given their ids, like send_code does.
 
-    if auth_method == "sms":
-        receiver = user.userdata.tlf
-        url = settings.SMS_AUTH_CODE_URL % dict(authid=event_id, code=code, email=user.email)
-    else: # email
-        receiver = user.email
-        url = settings.EMAIL_AUTH_CODE_URL % dict(authid=event_id, code=code, email=user.email)
+    Returns the number of messages sent, skipped because the user hasn't got
+    tlf or email, and failed.
+    '''
+    result = {'sent': 0, 'skipped': 0, 'failed': 0}
+    for status in send_codes_status(users, config).values():
+        result[status] += 1
+    return result
 
-    if receiver is None:
-        return "Receiver is none"
 
+def send_codes_status(users, config=None):
+    '''
+    Sends the codes to the users, given their ids, and returns the status of
+    each user id: sent, skipped or failed. The users are grouped by auth
+    event, so the event and its config are read once for each event.
+    '''
+    from api.models import UserData
+    statuses = {}
+    userdatas = UserData.objects.filter(user_id__in=users).select_related('user', 'event')
+    events = {}
+    for ud in userdatas:
+        if ud.event is None:
+            statuses[ud.user_id] = 'skipped'
+            continue
+        events.setdefault(ud.event_id, (ud.event, []))[1].append(ud)
+
+    for event, event_userdatas in events.values():
+        statuses.update(send_event_codes(event, event_userdatas, config))
+    return statuses
+
+
+def send_event_codes(event, userdatas, config=None):
+    '''
+    Sends the codes to the users of an auth event, returning the status of
+    each user id. The codes are created with a bulk insert, and the emails
+    are sent through one connection with the Reply-To resolved once.
+    '''
+    from api.models import ACL
+    from authmethods.audit import audit_buffer
+    from authmethods.models import Code, Message
+    from authmethods.rate import rate_limiter
+    from authmethods.sms_provider import SMSProvider
+    statuses = {}
+    auth_method = event.auth_method
+    conf = event.auth_method_config.get('config')
     if config is None:
-        msg = conf.get('msg')
-        subject = conf.get('subject')
-    else:
-        msg = config.get('msg')
-        subject = config.get('subject')
+        config = conf
 
     if auth_method == "sms":
         base_msg = settings.SMS_BASE_TEMPLATE
+        code_url = settings.SMS_AUTH_CODE_URL
     else: # email
         base_msg = settings.EMAIL_BASE_TEMPLATE
-    raw_msg = msg % dict(event_id=event_id, code=code, url=url)
-    msg = base_msg % raw_msg
+        code_url = settings.EMAIL_AUTH_CODE_URL
+
+    codes = []
+    messages = []
+    recipients = []
+    for ud in userdatas:
+        receiver = ud.tlf if auth_method == "sms" else ud.user.email
+        # if blank tlf or email
+        if not receiver:
+            statuses[ud.user_id] = 'skipped'
+            continue
+        code = random_code(settings.SIZE_CODE, CODE_CHARS)
+        codes.append(Code(user=ud, code=code, auth_event_id=event.id))
+        url = code_url % dict(authid=event.id, code=code, email=ud.user.email)
+        raw_msg = config.get('msg') % dict(event_id=event.id, code=code, url=url)
+        messages.append((receiver, base_msg % raw_msg))
+        recipients.append(ud.user_id)
+    Code.objects.bulk_create(codes)
 
     if auth_method == "sms":
-        send_sms_code(receiver, msg, conf)
-        m = Message(tlf=receiver, auth_event_id=event_id)
-        m.save()
-    else: # email
-        from api.models import ACL
-        acl = ACL.objects.filter(object_type='AuthEvent', perm='edit',
-                object_id=event_id).first()
-        email = EmailMessage(
-            subject,
-            msg,
-            settings.DEFAULT_FROM_EMAIL,
-            [receiver],
-            headers = {'Reply-To': acl.user.user.email}
-        )
-        send_email(email)
+        con = SMSProvider.get_instance()
+        results = con.send_sms_batch(messages)
+        for user_id, (receiver, msg), ok in zip(recipients, messages, results):
+            if not ok:
+                statuses[user_id] = 'failed'
+                continue
+            audit_buffer.add(Message(tlf=receiver, auth_event_id=event.id))
+            statuses[user_id] = 'sent'
+        return statuses
+
+    # email
+    headers = {}
+    acl = ACL.objects.filter(object_type='AuthEvent', perm='edit',
+            object_id=event.id).select_related('user__user').first()
+    if acl and acl.user.user.email:
+        headers['Reply-To'] = acl.user.user.email
+    limiter = rate_limiter('email')
+    connection = get_connection(fail_silently=True)
+    connection.open()
+    try:
+        for user_id, (receiver, msg) in zip(recipients, messages):
+            limiter.wait()
+            email = EmailMessage(
+                config.get('subject'),
+                msg,
+                settings.DEFAULT_FROM_EMAIL,
+                [receiver],
+                headers=headers,
+                connection=connection
+            )
+            try:
+                sent = connection.send_messages([email]) or 0
+            except Exception:
+                sent = 0
+            statuses[user_id] = 'sent' if sent else 'failed'
+    finally:
+        connection.close()
+    return statuses
 
 
 @celery.task
 def send_codes(users, config=None):
     ''' Massive send_code with celery task.  '''
-    user_objs = User.objects.filter(id__in=users)
-    for user in user_objs:
-        send_code(user, config)
+    return send_user_codes(users, config)
 
 
 # CHECKERS AUTHEVENT
@@ -306,10 +363,9 @@ def check_total_connection(fields):
     """
     msg = ''
     for field in fields:
-        if field in ('times'):
-            if field == 'times':
-                if not isinstance(fields[field], int):
-                    msg += "Invalid pipeline field: bad %s.\n" % field
+        if field in ('times', 'ip_times', 'period'):
+            if not isinstance(fields[field], int):
+                msg += "Invalid pipeline field: bad %s.\n" % field
         else:
             msg += "Invalid pipeline field: %s not possible.\n" % field
     return msg
@@ -326,6 +382,14 @@ def check_sms_code(fields):
             msg += "Invalid pipeline field: %s not possible.\n" % field
     return msg
 
+# checkers of the pipeline functions, by name
+PIPELINE_CHECKERS = {
+    'check_whitelisted': check_whitelisted,
+    'check_blacklisted': check_blacklisted,
+    'check_total_max': check_total_max,
+    'check_total_connection': check_total_connection,
+}
+
 def check_pipeline(pipe):
     """
     Check pipeline when create auth-event. This function call to other function
@@ -337,7 +401,7 @@ def check_pipeline(pipe):
             msg += "Invalid pipeline: %s not possible.\n" % p
         for func in pipe[p]:
             if func[0] in VALID_PIPELINES:
-                msg += getattr(eval(func[0]), '__call__')(func[1])
+                msg += PIPELINE_CHECKERS[func[0]](func[1])
             else:
                 msg += "Invalid pipeline functions: %s not possible.\n" % func
     return msg